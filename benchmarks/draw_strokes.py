@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# draw_strokes.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Reports how many points simplify_coords drops from freehand strokes,
+# and how long redrawing them takes before and after, both as straight
+# lines and as the curves drawn when utils.smooth_drawings is on.
+#
+#   python benchmarks/draw_strokes.py [strokes] [points per stroke] [tolerance]
+
+import os
+import sys
+import math
+import time
+import random
+from array import array
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+import cairo
+import DrawingThought
+
+REPEAT = 20
+
+def make_strokes (nstrokes, npoints):
+    # Random walks with gently changing direction, spaced like the
+    # averaged samples DrawingThought.handle_motion records
+    random.seed (0)
+    strokes = []
+    for i in xrange (nstrokes):
+        x = random.uniform (0, 800)
+        y = random.uniform (0, 600)
+        angle = random.uniform (0, 2 * math.pi)
+        coords = array ('d')
+        for p in xrange (npoints):
+            coords.extend ((x, y))
+            angle += random.uniform (-0.3, 0.3)
+            step = random.uniform (1, 3)
+            x += step * math.cos (angle)
+            y += step * math.sin (angle)
+        strokes.append (coords)
+    return strokes
+
+def redraw (strokes, curved):
+    surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, 1000, 800)
+    context = cairo.Context (surface)
+    context.set_line_width (2)
+    start = time.time ()
+    for i in xrange (REPEAT):
+        for coords in strokes:
+            DrawingThought.append_stroke_path (context, coords, curved)
+        context.stroke ()
+    surface.flush ()
+    return (time.time () - start) / REPEAT
+
+def main ():
+    nstrokes = len (sys.argv) > 1 and int (sys.argv[1]) or 200
+    npoints = len (sys.argv) > 2 and int (sys.argv[2]) or 500
+    tolerance = len (sys.argv) > 3 and float (sys.argv[3]) or 0.5
+
+    strokes = make_strokes (nstrokes, npoints)
+    start = time.time ()
+    simple = [DrawingThought.simplify_coords (c, tolerance) for c in strokes]
+    elapsed = time.time () - start
+
+    before = sum ([len (c) for c in strokes]) / 2
+    after = sum ([len (c) for c in simple]) / 2
+    print "%d strokes, tolerance %.2f: %d points -> %d points (%.1f%% fewer) in %.3f s" % \
+        (nstrokes, tolerance, before, after, 100.0 * (before - after) / before, elapsed)
+    for name, data, curved in (("original", strokes, False),
+                               ("simplified", simple, False),
+                               ("curved", simple, True)):
+        print "%-10s %8.2f ms per redraw" % (name, redraw (data, curved) * 1000)
+
+if __name__ == '__main__':
+    main ()
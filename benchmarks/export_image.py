@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# export_image.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Times the conversion ImageThought.export does to put a picture on a
+# surface without set_source_pixbuf (PDF, SVG), with the old per pixel
+# loop, the bytearray fallback and NumPy, and the cost of exporting the
+# same picture again once the converted surface is cached.  Exits with
+# 1 if the bytearray and NumPy conversions don't give the same bytes.
+#
+#   python benchmarks/export_image.py [width] [height]
+
+import os
+import sys
+import time
+import random
+import tempfile
+from array import array
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+import cairo
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+import utils
+
+def make_pixbuf (width, height):
+    random.seed (0)
+    row = bytearray ([random.randrange (256) for i in xrange (width * 4)])
+    data = str (row) * height
+    return GdkPixbuf.Pixbuf.new_from_bytes (GLib.Bytes.new (data), GdkPixbuf.Colorspace.RGB,
+                                            True, 8, width, height, width * 4)
+
+def legacy (pixels, width, height, rowstride, n_channels, has_alpha):
+    # What pixbuf_to_cairo used to do, one pixel at a time
+    pixels = bytearray (pixels)
+    data = array ('B', [0] * width * height * 4)
+    for y in range (height):
+        for x in range (width):
+            p = y * rowstride + x * n_channels
+            try:
+                alpha = has_alpha and pixels[p+3] or 255
+            except:
+                alpha = 255
+            alpha_mul = float (alpha) / 255
+
+            offset = (x + (y * width)) * 4
+            data[offset] = int (int (pixels[p+2]) * alpha_mul)
+            data[offset+1] = int (int (pixels[p+1]) * alpha_mul)
+            data[offset+2] = int (int (pixels[p]) * alpha_mul)
+            data[offset+3] = alpha
+    return data
+
+def time_convert (name, convert, pixbuf):
+    args = (pixbuf.get_pixels (), pixbuf.get_width (), pixbuf.get_height (),
+            pixbuf.get_rowstride (), pixbuf.get_n_channels (), pixbuf.get_has_alpha ())
+    start = time.time ()
+    data = convert (*args)
+    print "%-10s %8.3f s" % (name, time.time () - start)
+    return data
+
+def export (pixbuf, cached):
+    fd, path = tempfile.mkstemp (suffix='.pdf')
+    os.close (fd)
+    width = pixbuf.get_width ()
+    height = pixbuf.get_height ()
+    try:
+        surface = cairo.PDFSurface (path, width, height)
+        context = cairo.Context (surface)
+        start = time.time ()
+        if cached is None:
+            pixel_array = utils.pixbuf_to_cairo (pixbuf)
+            cached = cairo.ImageSurface.create_for_data (pixel_array, cairo.FORMAT_ARGB32,
+                                                         width, height, width * 4)
+        context.set_source_surface (cached, 0, 0)
+        context.rectangle (0, 0, width, height)
+        context.fill ()
+        surface.finish ()
+        return time.time () - start, cached
+    finally:
+        os.unlink (path)
+
+def main ():
+    width = len (sys.argv) > 1 and int (sys.argv[1]) or 1600
+    height = len (sys.argv) > 2 and int (sys.argv[2]) or 1200
+    pixbuf = make_pixbuf (width, height)
+    print "%dx%d RGBA picture" % (width, height)
+
+    time_convert ("legacy", legacy, pixbuf)
+    data = time_convert ("bytearray", utils.pixels_to_argb32_bytes, pixbuf)
+    if utils.numpy:
+        # Both round the way gdk does, so they have to agree exactly
+        if time_convert ("numpy", utils.pixels_to_argb32_numpy, pixbuf) != data:
+            print >> sys.stderr, "bytearray and numpy conversions differ"
+            sys.exit (1)
+
+    first, surface = export (pixbuf, None)
+    again, surface = export (pixbuf, surface)
+    print "PDF export %8.3f s, with the cached surface %8.3f s" % (first, again)
+
+if __name__ == '__main__':
+    main ()
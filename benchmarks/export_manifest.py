@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# export_manifest.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Times loading a bare MANIFEST (no archive, so no pictures) with
+# MapDocument and exporting it with ExportEngine, without a window.
+# Every tenth thought is an image, which then has to export as a
+# placeholder.  Some text thoughts are saved with identity 0, as older
+# versions did, and the map labyrinth-export loads must give them
+# identities of their own just like the activity does.  Exits with 1
+# if any export fails or identities are left shared.
+#
+#   python benchmarks/export_manifest.py [thoughts]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+here = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.join (here, '..'))
+sys.path.insert (0, os.path.join (here, '..', 'src'))
+
+import ExportEngine
+import MapDocument
+
+def make_manifest (path, nthoughts):
+    out = open (path, 'w')
+    out.write ('<?xml version="1.0" ?><MMap mode="1" title="benchmark">')
+    for i in xrange (nthoughts):
+        x = (i % 50) * 150
+        y = (i / 50) * 100
+        if i % 10:
+            identity = i % 25 != 1 and i or 0
+            out.write ('<thought identity="%d" ul-coords="(%d, %d)" lr-coords="(%d, %d)" '
+                       'background-color="#ffffffffffff" foreground-color="#000000000000" '
+                       'cursor="0">Thought %d</thought>' % (identity, x, y, x + 100, y + 70, i))
+        else:
+            out.write ('<image_thought identity="%d" ul-coords="(%d, %d)" lr-coords="(%d, %d)" '
+                       'file="images/%d.png" image_width="100" image_height="70"/>' % \
+                       (i, x, y, x + 100, y + 70, i))
+        if i:
+            out.write ('<link parent="%d" child="%d" start="(0, 0)" end="(1, 1)" strength="2"/>' % (i - 1, i))
+    out.write ('</MMap>')
+    out.close ()
+
+def main ():
+    nthoughts = len (sys.argv) > 1 and int (sys.argv[1]) or 500
+    directory = tempfile.mkdtemp ()
+    try:
+        path = os.path.join (directory, 'MANIFEST')
+        make_manifest (path, nthoughts)
+        targets = [ExportEngine.ExportTarget (f) for f in ExportEngine.FORMATS]
+        start = time.time ()
+        results = ExportEngine.ExportEngine (targets, 1).run ([path], directory)
+        print "%d thoughts, %d exports in %.3f s" % (nthoughts, len (results), time.time () - start)
+        failed = [r for r in results if r.error]
+        for result in failed:
+            print >> sys.stderr, "%s failed:\n%s" % (result.target.format, result.error)
+        # Loaded the way each export worker loads it
+        identities = [t.identity for t in MapDocument.load (path).thoughts]
+        shared = len (identities) - len (set (identities))
+        if shared:
+            print >> sys.stderr, "%d thoughts loaded with shared identities" % shared
+        if failed or shared:
+            sys.exit (1)
+    finally:
+        shutil.rmtree (directory)
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# load_manifest.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Compares opening a map MANIFEST with minidom.parseString (the old way)
+# against StreamLoader.parse.  Each run happens in a fresh process so the
+# peak RSS numbers don't influence each other.
+#
+#   python benchmarks/load_manifest.py [thoughts] [points per drawing]
+
+import os
+import sys
+import time
+import resource
+import tarfile
+import tempfile
+import subprocess
+import cStringIO
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'src'))
+
+def make_map (path, nthoughts, npoints):
+    out = cStringIO.StringIO ()
+    out.write ('<?xml version="1.0" ?><MMap mode="1" title="benchmark">')
+    for i in xrange (nthoughts):
+        x = (i % 50) * 150
+        y = (i / 50) * 100
+        if i % 2:
+            out.write ('<thought identity="%d" ul-coords="(%d, %d)" lr-coords="(%d, %d)" '
+                       'background-color="#ffffffffffff" foreground-color="#000000000000" '
+                       'cursor="0">Thought %d</thought>' % (i, x, y, x + 100, y + 70, i))
+        else:
+            out.write ('<drawing_thought identity="%d" ul-coords="(%d, %d)" lr-coords="(%d, %d)" '
+                       'min_x="%d" min_y="%d" max_x="%d" max_y="%d">' % \
+                       (i, x, y, x + 100, y + 70, x, y, x + 100, y + 70))
+            for p in xrange (npoints):
+                out.write ('<point coords="(%f, %f)" type="%d" color="#000000000000"/>' % \
+                           (x + p % 100, y + p % 70, p == 0 and 2 or 0))
+            out.write ('</drawing_thought>')
+        if i:
+            out.write ('<link parent="%d" child="%d" start="(0, 0)" end="(1, 1)" strength="2"/>' % (i - 1, i))
+    out.write ('</MMap>')
+
+    data = out.getvalue ()
+    tar = tarfile.open (path, 'w')
+    info = tarfile.TarInfo ('MANIFEST')
+    info.size = len (data)
+    tar.addfile (info, cStringIO.StringIO (data))
+    tar.close ()
+
+def walk (node):
+    # Touch what the load() methods of thoughts and links would
+    count = 0
+    for name in ("identity", "ul-coords", "lr-coords", "start", "end"):
+        node.getAttribute (name)
+    for n in node.childNodes:
+        if n.nodeType == n.TEXT_NODE:
+            n.data
+        else:
+            n.getAttribute ("coords")
+            n.getAttribute ("type")
+            count += 1
+    return count
+
+def load_minidom (path):
+    import xml.dom.minidom as dom
+    tar = tarfile.open (path)
+    doc = dom.parseString (tar.extractfile ('MANIFEST').read ())
+    top = doc.documentElement
+    top.getAttribute ("title")
+    count = 0
+    for node in top.childNodes:
+        count += walk (node)
+    tar.close ()
+    return count
+
+def load_stream (path):
+    import StreamLoader
+    tar = tarfile.open (path)
+    nodes = StreamLoader.parse (tar.extractfile ('MANIFEST'))
+    nodes.next ().getAttribute ("title")
+    count = 0
+    for node in nodes:
+        count += walk (node)
+    tar.close ()
+    return count
+
+def run_one (method, path):
+    start = time.time ()
+    count = {"minidom": load_minidom, "stream": load_stream}[method] (path)
+    elapsed = time.time () - start
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    print "%-8s %8.3f s  %8d kB peak RSS  (%d points)" % (method, elapsed, rss, count)
+
+def main ():
+    if len (sys.argv) == 4 and sys.argv[1] == "--run":
+        run_one (sys.argv[2], sys.argv[3])
+        return
+
+    nthoughts = len (sys.argv) > 1 and int (sys.argv[1]) or 2000
+    npoints = len (sys.argv) > 2 and int (sys.argv[2]) or 200
+    fd, path = tempfile.mkstemp (suffix='.tar')
+    os.close (fd)
+    try:
+        make_map (path, nthoughts, npoints)
+        print "%d thoughts, %d points per drawing, MANIFEST in %d bytes of tar" % \
+            (nthoughts, npoints, os.path.getsize (path))
+        for method in ("minidom", "stream"):
+            subprocess.call ([sys.executable, os.path.abspath (__file__), "--run", method, path])
+    finally:
+        os.unlink (path)
+
+if __name__ == '__main__':
+    main ()
@@ -21,7 +21,6 @@ import os
 import shutil
 import time
 from gettext import gettext as _
-import xml.dom.minidom as dom
 
 import cairo
 
@@ -61,6 +60,8 @@ sys.path.append(os.path.join(activity.get_bundle_path(), 'src'))
 
 import UndoManager
 import MMapArea
+import StreamLoader
+import TileExport
 import utils
 
 EMPTY = -800
@@ -976,8 +977,6 @@ class LabyrinthActivity(activity.Activity):
         del fileObject
 
     def __export_png_cb(self, event):
-        x, y, w, h, bitdepth = self._main_area.window.get_geometry()
-        cmap = self._main_area.window.get_colormap()
         maxx, maxy = self._main_area.get_max_area()
         true_width = int(maxx)
         true_height = int(maxy)
@@ -994,18 +993,8 @@ class LabyrinthActivity(activity.Activity):
         fileObject.file_path = os.path.join(self.get_activity_root(),
                                             'instance', '%i' % time.time())
         filename = fileObject.file_path
-        #pixmap = gtk.gdk.Pixmap(None, true_width, true_height, bitdepth)
-        #pixmap.set_colormap(cmap)
-        #self._main_area.export(pixmap.cairo_create(), true_width, true_height,
-        #                       False)
-
-        #pb = gtk.gdk.Pixbuf.get_from_drawable(
-        #    gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8, true_width,
-        #                   true_height),
-        #    pixmap, gtk.gdk.colormap_get_system(), 0, 0, 0, 0, true_width,
-        #    true_height)
-
-        pb.save(filename, 'png')
+        TileExport.export_png(self._main_area, filename, true_width,
+                              true_height, False)
         datastore.write(fileObject, transfer_ownership=True)
         fileObject.destroy()
         del fileObject
@@ -1018,14 +1007,14 @@ class LabyrinthActivity(activity.Activity):
     def read_file(self, file_path):
         tar = Tarball(file_path)
 
-        doc = dom.parseString(tar.read(tar.getnames()[0]))
-        top_element = doc.documentElement
+        nodes = StreamLoader.parse(tar.open(tar.getnames()[0]))
+        top_element = nodes.next()
 
         self.set_title(top_element.getAttribute("title"))
         self._mode = int(top_element.getAttribute("mode"))
 
         self._main_area.set_mode(self._mode)
-        self._main_area.load_thyself(top_element, doc, tar)
+        self._main_area.load_stream(nodes, tar)
 
         if top_element.hasAttribute("scale_factor"):
             fac = float(top_element.getAttribute("scale_factor"))
@@ -1041,15 +1030,18 @@ class LabyrinthActivity(activity.Activity):
     def write_file(self, file_path):
         tar = Tarball(file_path, 'w')
 
-        self._main_area.update_save()
-        manifest = self.serialize_to_xml(self._main_area.save,
-                self._main_area.element)
-        tar.write('MANIFEST', manifest)
+        self.set_manifest_attributes(self._main_area.element)
+        self._main_area.write_manifest(tar, 'MANIFEST')
         self._main_area.save_thyself(tar)
 
         tar.close()
 
     def serialize_to_xml(self, doc, top_element):
+        self.set_manifest_attributes(top_element)
+        string = doc.toxml()
+        return string.encode("utf-8")
+
+    def set_manifest_attributes(self, top_element):
         top_element.setAttribute("title", self.props.title)
         top_element.setAttribute("mode", str(self._mode))
         top_element.setAttribute("size", str((400, 400)))
@@ -1061,5 +1053,3 @@ class LabyrinthActivity(activity.Activity):
                                  str(self._main_area.scale_fac))
         top_element.setAttribute("translation",
                                  str(self._main_area.translation))
-        string = doc.toxml()
-        return string.encode("utf-8")
@@ -14,13 +14,10 @@
 
 """Simplify tarfile module usage"""
 
-import os
 import time
 import tarfile
 import cStringIO
 import zipfile
-import tempfile
-import shutil
 
 from gi.repository import Gtk
 from gi.repository import GdkPixbuf
@@ -34,12 +31,36 @@ class BadDataTypeError(TarballError):
     """Exception for unsupported data type in read/write methods."""
     pass
 
+def decode_pixbuf(data):
+    """
+    Returns pixbuf object decoded from given string with image file content,
+    in any format GdkPixbuf knows.
+    Does not touch Gtk, so it may be called from worker threads.
+    """
+    loader = GdkPixbuf.PixbufLoader()
+    loader.write(data)
+    loader.close()
+    return loader.get_pixbuf()
+
+
+def encode_pixbuf(pixbuf):
+    """Returns string with given pixbuf object saved as PNG."""
+    def push(pixbuf, buffer):
+        buffer.write(pixbuf)
+
+    buffer = cStringIO.StringIO()
+    pixbuf.save_to_callback(push, 'png', user_data=buffer)
+    return buffer.getvalue()
+
+
 class Tarball:
     """
     Wrap standart tarfile module to simplify read/write operations with
     most popular data types.
 
-    In read mode Tarball can load zip files as well.
+    In read mode Tarball can load zip files as well, reading them directly.
+    Members are looked up through an index built when the file is opened,
+    so reads and exists() don't depend on the number of members.
 
     Supprted types:
 
@@ -72,36 +93,31 @@ class Tarball:
 
         # read content of file in tarball to pixbuf object
         pixbuf_content = tar.read_pixbuf('name within tarball')
+
+        # check for a file in tarball
+        if tar.exists('name within tarball'): ...
     """
 
     def __init__(self, name=None, mode='r', mtime=None):
+        self.__tar = None
+        self.__zip = None
+        # member name -> TarInfo or ZipInfo, and the names in file order
+        self.__members = {}
+        self.__names = []
+
         if not mode.startswith('r') or tarfile.is_tarfile(name):
             self.__tar = tarfile.TarFile(name=name, mode=mode)
+            if mode.startswith('r'):
+                for info in self.__tar.getmembers():
+                    self.__index(info.name, info)
 
         else:
-            # convert for tar
-
             if not zipfile.is_zipfile(name):
                 raise tarfile.ReadError()
 
-            try:
-                tmp_dir = tempfile.mkdtemp()
-                tmp_fd, tmp_name = tempfile.mkstemp()
-                tmp_fo = os.fdopen(tmp_fd, 'w')
-
-                zip = zipfile.ZipFile(name)
-                zip.extractall(tmp_dir)
-
-                tar = tarfile.TarFile(fileobj=tmp_fo, mode='w')
-                tar.add(tmp_dir, arcname='')
-                tar.close()
-
-                self.__tar = tarfile.TarFile(name=tmp_name, mode=mode)
-
-            finally:
-                tmp_fo.close()
-                os.unlink(tmp_name)
-                shutil.rmtree(tmp_dir)
+            self.__zip = zipfile.ZipFile(name)
+            for info in self.__zip.infolist():
+                self.__index(info.filename, info)
 
         if mtime:
             self.mtime = mtime
@@ -111,15 +127,22 @@ class Tarball:
 
     def close(self):
         """Save(if 'r' mode was given) and close tarball file."""
-        self.__tar.close()
+        if self.__zip:
+            self.__zip.close()
+        else:
+            self.__tar.close()
 
     def getnames(self):
         """Return names of members sorted by creation order."""
-        return self.__tar.getnames()
+        return list(self.__names)
+
+    def exists(self, arcname):
+        """Returns True if tarball has a file with the given name."""
+        return arcname.encode('utf8') in self.__members
 
     def read(self, arcname):
         """Returns sring with content of given file from tarball."""
-        file_o = self.__tar.extractfile(arcname.encode('utf8'))
+        file_o = self.open(arcname)
         if not file_o:
             return None
 
@@ -127,12 +150,19 @@ class Tarball:
         file_o.close()
         return out
 
+    def open(self, arcname):
+        """
+        Returns file object to read content of given file from tarball.
+        Raises KeyError if there is no such file.
+        """
+        info = self.__members[arcname.encode('utf8')]
+        if self.__zip:
+            return self.__zip.open(info)
+        return self.__tar.extractfile(info)
+
     def read_pixbuf(self, arcname):
         """Returns pixbuf object of given file from tarball."""
-        loader = GdkPixbuf.PixbufLoader.new_with_mime_type('image/png')
-        loader.write(self.read(arcname))
-        loader.close()
-        return loader.get_pixbuf()
+        return decode_pixbuf(self.read(arcname))
 
     def write(self, arcname, data, mode=0644):
         """
@@ -152,17 +182,59 @@ class Tarball:
         else:
             raise BadDataTypeError()
 
+    def write_chunks(self, arcname, chunks, mode=0644):
+        """
+        Stores the concatenation of given strings to file in tarball,
+        without joining them into one string first.
+        """
+        info = tarfile.TarInfo(arcname.encode('utf8'))
+        info.mode = mode
+        info.mtime = self.mtime
+        info.size = sum([len(i) for i in chunks])
+        self.__add(info, _ChunkReader(chunks))
+
+    def __index(self, name, info):
+        # Like tarfile, the last member with a name wins
+        if name not in self.__members:
+            self.__names.append(name)
+        self.__members[name] = info
+
+    def __add(self, info, fileobj):
+        self.__tar.addfile(info, fileobj)
+        self.__index(info.name, info)
+
     def __write_str(self, info, data):
         info.size = len(data)
-        self.__tar.addfile(info, cStringIO.StringIO(data))
+        self.__add(info, cStringIO.StringIO(data))
         
     def __write_pixbuf(self, info, data):
-        def push(pixbuf, buffer):
-            buffer.write(pixbuf)
-
-        buffer = cStringIO.StringIO()
-        data.save_to_callback(push, 'png', user_data=buffer)
-
-        info.size = buffer.tell()
-        buffer.seek(0)
-        self.__tar.addfile(info, buffer)
+        self.__write_str(info, encode_pixbuf(data))
+
+
+class _ChunkReader:
+    """File-like object reading through a sequence of strings."""
+
+    def __init__(self, chunks):
+        self.__chunks = iter(chunks)
+        self.__chunk = ''
+        self.__offset = 0
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            if self.__offset >= len(self.__chunk):
+                try:
+                    self.__chunk = self.__chunks.next()
+                except StopIteration:
+                    break
+                self.__offset = 0
+                continue
+
+            end = len(self.__chunk)
+            if size > 0:
+                end = min(end, self.__offset + size)
+                size -= end - self.__offset
+            out.append(self.__chunk[self.__offset:end])
+            self.__offset = end
+
+        return ''.join(out)
@@ -29,15 +29,24 @@ import utils
 import TextBufferMarkup
 import UndoManager
 
-UNDO_RESIZE = 0
-UNDO_DRAW = 1
-UNDO_ERASE = 2
+# Undo types of thoughts, apart from those of MMapArea (0 - 9), so the
+# coalescing rules of one never see actions of the other
+UNDO_RESIZE = 32
+UNDO_DRAW = 33
+UNDO_ERASE = 34
 
 MIN_SIZE = 20
 
 DEFAULT_WIDTH    = 100
 DEFAULT_HEIGHT    = 70
 
+def combine_resizes (back, action):
+    ''' Coalescing rule for a burst of resizes of the same thought: from \
+        the size before the first to the size after the last '''
+    if not UndoManager.in_burst (back, action):
+        return None
+    return UndoManager.UndoAction (action.owner, UNDO_RESIZE, action.callback, back.args[0], action.args[1])
+
 class BaseThought (GObject.GObject):
     ''' The basic class to derive other thoughts from. \
         Instructions for creating derivative thought types are  \
@@ -103,9 +112,12 @@ class BaseThought (GObject.GObject):
         self.extended_buffer.set_text("")
         self.extended_buffer.connect ("set_focus", self.focus_buffer)
         self.extended_buffer.connect ("set_attrs", self.set_extended_attrs)
+        for signal in ("changed", "apply-tag", "remove-tag", "mark-set"):
+            self.extended_buffer.connect (signal, self.mark_dirty)
         self.element = save.createElement (elem_type)
         self.element.appendChild (extended_elem)
         self.creating = True
+        self.xml_cache = None
 
     # These are self-explanitory.  You probably don't want to
     # overwrite these methods, unless you have a very good reason
@@ -129,6 +141,11 @@ class BaseThought (GObject.GObject):
     def okay (self):
         return self.all_okay
 
+    def memory_size (self):
+        ''' Rough count of the bytes the thought keeps alive, for the undo \
+            history to account for deleted thoughts '''
+        return 1024 + len (self.text)
+
     def move_content_by (self, x, y):
         pass
 
@@ -188,9 +205,25 @@ class BaseThought (GObject.GObject):
     def draw (self, context):
         pass
 
+    # Thoughts that look the same as long as this value doesn't change
+    # can be drawn from a cached copy (see RenderCache.py).  None means
+    # the thought is drawn directly every time
+    def render_key (self):
+        return None
+
     def load (self, node, tar):
         pass
 
+    # The saved XML of a thought is kept between saves (see
+    # MMapArea.write_manifest).  It is rebuilt when save_key() changes,
+    # or after mark_dirty() for changes the key doesn't cover
+    def save_key (self):
+        return (self.ul, self.lr, self.identity, self.text,
+                self.am_selected, self.am_primary)
+
+    def mark_dirty (self, *args):
+        self.xml_cache = None
+
     def update_save (self):
         pass
 
@@ -430,12 +463,19 @@ class ResizableThought (BaseThought):
         self.ul = action.args[choose][0]
         self.width = action.args[choose][1]
         self.height = action.args[choose][2]
-        self.pic = self.orig_pic.scale_simple (int(self.width), int(self.height), GdkPixbuf.InterpType.HYPER)
         self.recalc_edges ()
         self.emit ("update_links")
         self.emit ("update_view")
         self.undo.unblock ()
 
+    def render_key (self):
+        if self.creating or not self.ul or not self.lr:
+            return None
+        return (self.lr[0] - self.ul[0], self.lr[1] - self.ul[1],
+                utils.gtk_to_cairo_color(self.background_color),
+                self.am_selected, self.am_primary,
+                len (self.extended_buffer.get_text()) == 0)
+
     def draw (self, context):
         if len (self.extended_buffer.get_text()) == 0:
             utils.draw_thought_outline (context, self.ul, self.lr,
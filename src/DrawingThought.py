@@ -23,9 +23,12 @@ import xml.dom.minidom as dom
 import xml.dom
 import gettext
 _ = gettext.gettext
+import sys
 import math
+import base64
 import logging
 import cairo
+from array import array
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -34,36 +37,279 @@ from BaseThought import *
 import utils
 import UndoManager
 
+# Point styles of the old <point> save format
 STYLE_CONTINUE=0
 STYLE_END=1
 STYLE_BEGIN=2
 ndraw =0
 SMOOTH = 5
+ERASER_RADIUS = 4
+# Size of the cells of the eraser's SegmentGrid
+SEGMENT_CELL_SIZE = 16
+
+def encode_coords (coords):
+	# Stored as little endian 32 bit floats: plenty for map coordinates
+	# and half the size of doubles
+	packed = array ('f', coords)
+	if sys.byteorder == 'big':
+		packed.byteswap ()
+	return base64.b64encode (packed.tostring ())
+
+def decode_coords (text):
+	packed = array ('f')
+	packed.fromstring (base64.b64decode (text))
+	if sys.byteorder == 'big':
+		packed.byteswap ()
+	return array ('d', packed)
+
+def erase_stroke (coords, cx, cy, radius, segments = None):
+	''' Cuts the circle (cx, cy, radius) out of a stroke.  Only the \
+		segments listed (by the index of their first point) are looked at, \
+		all of them if segments is None.  Returns None if the stroke \
+		doesn't touch the circle, otherwise the (possibly empty) list of \
+		coordinate arrays left over '''
+	r2 = radius * radius
+	npoints = len (coords) / 2
+	if npoints == 1:
+		if (coords[0] - cx)**2 + (coords[1] - cy)**2 < r2:
+			return []
+		return None
+	if segments is None:
+		segments = xrange (npoints - 1)
+	else:
+		segments = sorted (segments)
+
+	# Find where the circle cuts the stroke before building anything
+	cuts = []
+	for i in segments:
+		x0, y0 = coords[2*i], coords[2*i+1]
+		dx = coords[2*i+2] - x0
+		dy = coords[2*i+3] - y0
+		fx = x0 - cx
+		fy = y0 - cy
+		a = dx*dx + dy*dy
+		c = fx*fx + fy*fy - r2
+		if a == 0:
+			if c < 0:
+				cuts.append ((i, 0.0, 1.0))
+			continue
+		# Where the segment enters (t1) and leaves (t2) the circle
+		b = 2 * (fx*dx + fy*dy)
+		disc = b*b - 4*a*c
+		if disc <= 0:
+			continue
+		root = math.sqrt (disc)
+		t1 = (-b - root) / (2*a)
+		t2 = (-b + root) / (2*a)
+		if t1 < 1 and t2 > 0:
+			cuts.append ((i, t1, t2))
+
+	if not cuts:
+		return None
+
+	# Copy the runs of points between the cuts in one go each.  A point
+	# inside the circle always has its segments cut with t1 <= 0 or
+	# t2 >= 1, so it is never copied.
+	pieces = []
+	current = array ('d')
+	start = 0
+	for i, t1, t2 in cuts:
+		x0, y0 = coords[2*i], coords[2*i+1]
+		dx = coords[2*i+2] - x0
+		dy = coords[2*i+3] - y0
+		if t1 > 0:
+			current.extend (coords[2*start:2*i+2])
+			current.extend ((x0 + t1*dx, y0 + t1*dy))
+		if len (current) >= 4:
+			pieces.append (current)
+		current = array ('d')
+		if t2 < 1:
+			current.extend ((x0 + t2*dx, y0 + t2*dy))
+		start = i + 1
+
+	if cuts[-1][2] < 1:
+		current.extend (coords[2*start:])
+	if len (current) >= 4:
+		pieces.append (current)
+	return pieces
+
+def simplify_coords (coords, tolerance):
+	''' Ramer-Douglas-Peucker simplification of a stroke: drops every \
+		point that lies within tolerance of the line kept in its place. \
+		Returns a new array, the first and last points are always kept'''
+	npoints = len (coords) / 2
+	if npoints < 3 or tolerance <= 0:
+		return coords
+	limit = tolerance * tolerance
+	keep = bytearray (npoints)
+	keep[0] = keep[-1] = 1
+	# An explicit stack, long strokes would run into the recursion limit
+	stack = [(0, npoints - 1)]
+	while stack:
+		first, last = stack.pop ()
+		x0, y0 = coords[2*first], coords[2*first+1]
+		dx = coords[2*last] - x0
+		dy = coords[2*last+1] - y0
+		length = dx*dx + dy*dy
+		furthest = 0
+		distance = 0.0
+		for i in xrange (first + 1, last):
+			px = coords[2*i] - x0
+			py = coords[2*i+1] - y0
+			if length == 0:
+				d = px*px + py*py
+			else:
+				cross = px*dy - py*dx
+				d = cross * cross / length
+			if d > distance:
+				furthest = i
+				distance = d
+		if distance > limit:
+			keep[furthest] = 1
+			stack.append ((first, furthest))
+			stack.append ((furthest, last))
+
+	result = array ('d')
+	for i in xrange (npoints):
+		if keep[i]:
+			result.extend ((coords[2*i], coords[2*i+1]))
+	return result
+
+def append_stroke_path (context, coords, curved = False):
+	''' Adds a stroke to the current path of context.  If curved, the \
+		points are joined by a Catmull-Rom spline, drawn as cubic Bezier \
+		curves, so simplified strokes still look smooth '''
+	context.move_to (coords[0], coords[1])
+	n = len (coords)
+	if not curved or n < 6:
+		for i in xrange (2, n, 2):
+			context.line_to (coords[i], coords[i+1])
+		return
+	for i in xrange (0, n - 2, 2):
+		# The points before and after the segment, repeating the ends
+		p = max (i - 2, 0)
+		q = min (i + 4, n - 2)
+		context.curve_to (coords[i] + (coords[i+2] - coords[p]) / 6.,
+						  coords[i+1] + (coords[i+3] - coords[p+1]) / 6.,
+						  coords[i+2] - (coords[q] - coords[i]) / 6.,
+						  coords[i+3] - (coords[q+1] - coords[i+1]) / 6.,
+						  coords[i+2], coords[i+3])
+
+class SegmentGrid (object):
+	''' A uniform grid over the segments of a drawing's strokes, so the \
+		eraser only has to look at segments near it.  Coordinates are \
+		relative to the drawing's origin, like the strokes themselves'''
+
+	def __init__ (self, cell_size = SEGMENT_CELL_SIZE):
+		self.cell_size = float (cell_size)
+		# (cx, cy) -> {stroke: [segment, ...]}
+		self.cells = {}
+		# stroke -> cells it was added to
+		self.cells_of = {}
+
+	def cell_range (self, x0, y0, x1, y1):
+		size = self.cell_size
+		return (int (math.floor (min (x0, x1) / size)), int (math.floor (min (y0, y1) / size)),
+				int (math.floor (max (x0, x1) / size)), int (math.floor (max (y0, y1) / size)))
+
+	def add (self, stroke):
+		coords = stroke.coords
+		touched = set ()
+		if len (coords) == 2:
+			segments = [(0, coords[0], coords[1], coords[0], coords[1])]
+		else:
+			segments = [(i / 2, coords[i], coords[i+1], coords[i+2], coords[i+3]) \
+						for i in xrange (0, len (coords) - 2, 2)]
+		for i, x0, y0, x1, y1 in segments:
+			cx0, cy0, cx1, cy1 = self.cell_range (x0, y0, x1, y1)
+			for cx in xrange (cx0, cx1 + 1):
+				for cy in xrange (cy0, cy1 + 1):
+					self.cells.setdefault ((cx, cy), {}).setdefault (stroke, []).append (i)
+					touched.add ((cx, cy))
+		self.cells_of[stroke] = touched
+
+	def remove (self, stroke):
+		for key in self.cells_of.pop (stroke, ()):
+			cell = self.cells[key]
+			del cell[stroke]
+			if not cell:
+				del self.cells[key]
+
+	def sync (self, strokes):
+		''' Brings the grid up to date with the given list of strokes '''
+		current = set (strokes)
+		for s in [s for s in self.cells_of if s not in current]:
+			self.remove (s)
+		for s in strokes:
+			if s not in self.cells_of:
+				self.add (s)
+
+	def query (self, x0, y0, x1, y1):
+		''' Returns {stroke: set of segments} for the segments whose \
+			bounding boxes may touch the given rectangle '''
+		found = {}
+		cx0, cy0, cx1, cy1 = self.cell_range (x0, y0, x1, y1)
+		for cx in xrange (cx0, cx1 + 1):
+			for cy in xrange (cy0, cy1 + 1):
+				cell = self.cells.get ((cx, cy))
+				if not cell:
+					continue
+				for stroke, segments in cell.iteritems ():
+					found.setdefault (stroke, set ()).update (segments)
+		return found
 
 class DrawingThought(ResizableThought):
-	class DrawingPoint (object):
-		def __init__ (self, coords, style=STYLE_CONTINUE, color = Gdk.Color(0,0,0), width = 2):
-			self.x, self.y = coords
-			self.style = style
-			if color == None:
-				color = Gdk.Color(0,0,0)
+	class Stroke (object):
+		''' One continuous line of a drawing.  Its points are kept as x, y \
+			pairs in a flat array, relative to the origin of the drawing. \
+			Erasing replaces strokes instead of changing them, so undo only \
+			has to hold on to the old list of strokes'''
+		__slots__ = ('coords', 'color')
+
+		def __init__ (self, coords = None, color = None):
+			if coords is None:
+				coords = array ('d')
+			self.coords = coords
 			self.color = color
-			self.width = 1
-		def move_by (self, x, y):
-			self.x += x
-			self.y += y
+
+		def undo_size (self):
+			return len (self.coords) * self.coords.itemsize
 
 	def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
 		global ndraw
 		super (DrawingThought, self).__init__(coords, save, "drawing_thought", undo, background_color, foreground_color)
 		ndraw+=1
 		self.identity = thought_number
-		self.points = []
+		self.strokes = []
+		# Moving the drawing only moves its origin, not every point
+		self.origin = (0.0, 0.0)
+		self.current_stroke = None
+		self.segments = SegmentGrid ()
 		self.text = _("Drawing #%d" % ndraw)
 		self.drawing = 0
 		self.all_okay = True
 		self.coords_smooth = []
 
+	def memory_size (self):
+		return ResizableThought.memory_size (self) + sum ([s.undo_size () for s in self.strokes])
+
+	def render_key (self):
+		if self.drawing:
+			return None
+		key = ResizableThought.render_key (self)
+		if key is None:
+			return None
+		# Finished strokes never change, so the list of them says it all
+		return key + (self.origin[0] - self.ul[0], self.origin[1] - self.ul[1],
+					  self.foreground_color.to_string(), utils.smooth_drawings, tuple(self.strokes))
+
+	def trace_strokes (self, context, move_x = 0, move_y = 0):
+		context.save ()
+		context.translate (self.origin[0] + move_x, self.origin[1] + move_y)
+		for s in self.strokes:
+			append_stroke_path (context, s.coords, utils.smooth_drawings)
+		context.restore ()
+
 	def draw (self, context):
 		ResizableThought.draw(self, context)
 
@@ -71,17 +317,11 @@ class DrawingThought(ResizableThought):
 		context.set_line_width (2)
 		context.set_line_join(cairo.LINE_JOIN_BEVEL)
 		context.set_line_cap(cairo.LINE_CAP_ROUND)
-		if len (self.points) > 0:
-			for p in self.points:
-				if p.style == STYLE_BEGIN:
-					context.move_to (p.x, p.y)
-					r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
-					context.set_source_rgb (r, g, b)
-				elif p.style == STYLE_END:
-					context.line_to (p.x, p.y)
-					context.stroke()
-				else:
-					context.line_to (p.x, p.y)
+		if self.strokes:
+			r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
+			context.set_source_rgb (r, g, b)
+			self.trace_strokes (context)
+			context.stroke ()
 
 		context.set_line_width (cwidth)
 		context.stroke ()
@@ -94,12 +334,10 @@ class DrawingThought(ResizableThought):
 		self.undo.block ()
 		if mode == UndoManager.UNDO:
 			choose = 1
-			for p in action.args[0]:
-				self.points.remove (p)
+			self.strokes = list (action.args[0])
 		else:
 			choose = 2
-			for p in action.args[0]:
-				self.points.append (p)
+			self.strokes = list (action.args[3])
 
 		self.ul = action.args[choose][0]
 		self.width = action.args[choose][1]
@@ -119,16 +357,25 @@ class DrawingThought(ResizableThought):
 			if not event.state & Gdk.ModifierType.SHIFT_MASK:
 				self.drawing = 1
 			self.orig_size = (self.ul, self.width, self.height)
-			self.ins_points = []
-			self.del_points = []
+			self.orig_strokes = list (self.strokes)
+			self.current_stroke = None
+			if self.drawing == 2:
+				self.segments.sync (self.strokes)
 			return True
 
 		return False
 
-	def process_button_release (self, event, transformed):
-		if len(self.points) > 0:
-			self.points[-1].style=STYLE_END
+	def finish_stroke (self):
+		stroke = self.current_stroke
+		if stroke is None or not utils.drawing_tolerance:
+			return
+		coords = simplify_coords (stroke.coords, utils.drawing_tolerance)
+		if len (coords) < len (stroke.coords):
+			utils.print_debug ("Simplified stroke from %d to %d points" % \
+					   (len (stroke.coords) / 2, len (coords) / 2))
+			self.strokes[self.strokes.index (stroke)] = self.Stroke (coords, stroke.color)
 
+	def process_button_release (self, event, transformed):
 		if self.orig_size:
 			if self.drawing == 0:
 				# correct sizes after creation
@@ -143,14 +390,16 @@ class DrawingThought(ResizableThought):
 							self.undo_resize, self.orig_size, (self.ul, self.width, self.height)))
 
 			elif self.drawing == 1:
+				self.finish_stroke ()
 				self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DRAW, \
-						self.undo_drawing, self.ins_points, self.orig_size, \
-						(self.ul, self.width, self.height)))
+						self.undo_drawing, self.orig_strokes, self.orig_size, \
+						(self.ul, self.width, self.height), list (self.strokes)))
 
 			elif self.drawing == 2:
 				self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ERASE, \
-						self.undo_erase, self.ins_points))
+						self.undo_erase, self.orig_strokes, list (self.strokes)))
 
+		self.current_stroke = None
 		self.drawing = 0
 		return ResizableThought.process_button_release(self, event, transformed)
 
@@ -160,22 +409,39 @@ class DrawingThought(ResizableThought):
 
 	def undo_erase (self, action, mode):
 		self.undo.block ()
-		action.args[0].reverse ()
 		if mode == UndoManager.UNDO:
-			for x in action.args[0]:
-				if x[0] == 0:
-					self.points.remove (x[2])
-				else:
-					self.points.insert (x[1],x[2])
+			self.strokes = list (action.args[0])
 		else:
-			for x in action.args[0]:
-				if x[0] == 0:
-					self.points.insert (x[1], x[2])
-				else:
-					self.points.remove (x[2])
+			self.strokes = list (action.args[1])
 		self.undo.unblock ()
 		self.emit ("update_view")
 
+	def erase_at (self, coords):
+		cx = coords[0] - self.origin[0]
+		cy = coords[1] - self.origin[1]
+		r = ERASER_RADIUS
+		near = self.segments.query (cx - r, cy - r, cx + r, cy + r)
+		replaced = {}
+		for s, segments in near.iteritems ():
+			pieces = erase_stroke (s.coords, cx, cy, r, segments)
+			if pieces is not None:
+				replaced[s] = [self.Stroke (p, s.color) for p in pieces]
+		if not replaced:
+			return False
+
+		# Put the pieces in place of the strokes they came from, in one pass
+		strokes = []
+		for s in self.strokes:
+			if s in replaced:
+				self.segments.remove (s)
+				for p in replaced[s]:
+					self.segments.add (p)
+					strokes.append (p)
+			else:
+				strokes.append (s)
+		self.strokes = strokes
+		return True
+
 	def handle_motion (self, event, coords):
 		if ResizableThought.handle_motion(self, event, coords):
 			return True
@@ -189,7 +455,7 @@ class DrawingThought(ResizableThought):
 			return False
 		else:
 			coords = (float(sum([i[0] for i in self.coords_smooth])) / SMOOTH,
-                      float(sum([i[1] for i in self.coords_smooth])) / SMOOTH)
+					  float(sum([i[1] for i in self.coords_smooth])) / SMOOTH)
 			self.coords_smooth = []
 
 		if self.drawing == 1:
@@ -212,138 +478,29 @@ class DrawingThought(ResizableThought):
 				self.max_y = coords[1]+5
 			self.width = self.lr[0] - self.ul[0]
 			self.height = self.lr[1] - self.ul[1]
-			if len(self.points) == 0 or self.points[-1].style == STYLE_END:
-				p = self.DrawingPoint (coords, STYLE_BEGIN, self.foreground_color)
-			else:
-				p = self.DrawingPoint (coords, STYLE_CONTINUE)
-			self.points.append (p)
-			self.ins_points.append (p)
+			if self.current_stroke is None:
+				self.current_stroke = self.Stroke (color = self.foreground_color)
+				self.strokes.append (self.current_stroke)
+			self.current_stroke.coords.extend ((coords[0] - self.origin[0], coords[1] - self.origin[1]))
 			return True
 
-		elif self.drawing == 2 and len (self.points) > 0:
-			out = self.points[0]
-			loc = []
-			handle = []
-			ins_point = -1
-
-			for x in self.points:
-				ins_point += 1
-				dist = (x.x - coords[0])**2 + (x.y - coords[1])**2
-
-				if dist < 16:
-					if x == self.points[0]:
-						out = None
-					loc.append ((ins_point, x, dist))
-				else:
-					if len(loc) != 0:
-						handle.append ((loc, out, x))
-						loc = []
-					elif x.style != STYLE_BEGIN:
-						x1 = x.x - out.x
-						y1 = x.y - out.y
-						d_rsqr = x1**2 + y1 **2
-						d = ((out.x-coords[0])*(x.y-coords[1]) - (x.x-coords[0])*(out.y-coords[1]))
-						det = (d_rsqr*16) - d**2
-						if det > 0:
-							xt = -99999
-							yt = -99999
-							xalt = -99999
-							yalt = -99999
-							if y1 < 0:
-								sgn = -1
-							else:
-								sgn = 1
-							xt = (((d*y1) + sgn*x1 * math.sqrt (det)) / d_rsqr) +coords[0]
-							xalt = (((d*y1) - sgn*x1 * math.sqrt (det)) / d_rsqr) +coords[0]
-							yt = (((-d*x1) + abs(y1)*math.sqrt(det)) / d_rsqr) + coords[1]
-							yalt = (((-d*x1) - abs(y1)*math.sqrt(det)) / d_rsqr) +coords[1]
-							x1_inside = (xt > x.x and xt < out.x) or (xt > out.x and xt < x.x)
-							x2_inside = (xalt > x.x and xalt < out.x) or (xalt > out.x and xalt < x.x)
-							y1_inside = (yt > x.y and yt < out.y) or (yt > out.y and yt < x.y)
-							y2_inside = (yalt > x.y and yalt < out.y) or (yalt > out.y and yalt < x.y)
-
-
-							if (x1_inside and x2_inside and y1_inside and y2_inside):
-							   	if abs (xalt - x.x) < abs (xt - x.x):
-							   		handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-							   	else:
-							   		handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-							elif x.x == out.x and y1_inside and y2_inside:
-							   	if abs (yalt - x.y) < abs (yt - x.y):
-							   		handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-							   	else:
-							   		handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-							elif x.y == out.y and x1_inside and x2_inside:
-								if abs (xalt - x.x) < abs (xt - x.x):
-								   	handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-								else:
-								   	handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-
-					out = x
-			if loc:
-				handle.append ((loc, out, None))
-			appends = []
-			dels = []
-			for l in handle:
-				inside = l[0]
-				prev = l[1]
-				next = l[2]
-				if not inside:
-					ins = l[3]
-					x1 = l[4]
-					x2 = l[5]
-					y1 = l[6]
-					y2 = l[7]
-					p1 = self.DrawingPoint ((x1,y1), STYLE_END)
-					p2 = self.DrawingPoint ((x2,y2), STYLE_BEGIN)
-					appends.append ((p1, ins))
-					appends.append ((p2, ins))
-				else:
-					first = inside[0][1]
-					last = inside[-1][1]
-					done_ins = 0
-					if last.style != STYLE_END:
-						end_dist = math.sqrt (inside[-1][2]) - 4
-						alpha = math.atan2 ((last.y-next.y), (last.x-next.x))
-						new_x = end_dist * math.cos(alpha) + last.x
-						new_y = end_dist * math.sin(alpha) + last.y
-						p = self.DrawingPoint ((new_x, new_y), STYLE_BEGIN)
-						appends.append ((p, inside[-1][0]))
-						done_ins = 1
-					if first.style != STYLE_BEGIN:
-						start_dist = math.sqrt (inside[0][2]) - 4
-						alpha = math.atan2 ((first.y-prev.y),(first.x-prev.x))
-						new_x = start_dist * math.cos (alpha) + first.x
-						new_y = start_dist * math.sin (alpha) + first.y
-						p = self.DrawingPoint ((new_x, new_y), STYLE_END)
-						appends.append ((p, inside[0][0]-done_ins))
-					for i in inside:
-						dels.append (i[1])
-			inserts = 0
-			for x in appends:
-				self.points.insert (x[1]+inserts, x[0])
-				self.ins_points.append ((0, x[1]+inserts, x[0]))
-				inserts+=1
-			for x in dels:
-				self.ins_points.append ((1, self.points.index (x), x))
-				self.points.remove (x)
-
-			return True
+		elif self.drawing == 2 and self.strokes:
+			return self.erase_at (coords)
 
 		return False
 
 	def move_content_by(self, x, y):
-		map(lambda p : p.move_by(x,y), self.points)
+		self.origin = (self.origin[0] + x, self.origin[1] + y)
 		ResizableThought.move_content_by(self, x, y)
 
 	def update_save (self):
 		next = self.element.firstChild
 		while next:
 			m = next.nextSibling
-			if next.nodeName == "point":
+			if next.nodeName == "point" or next.nodeName == "stroke":
 				self.element.removeChild (next)
 				next.unlink ()
-			next = m		
+			next = m
 		text = self.extended_buffer.get_text ()
 		if text:
 			self.extended_buffer.update_save()
@@ -361,9 +518,10 @@ class DrawingThought(ResizableThought):
 		self.element.setAttribute ("min_y", str(self.min_y))
 		self.element.setAttribute ("max_x", str(self.max_x))
 		self.element.setAttribute ("max_y", str(self.max_y))
+		self.element.setAttribute ("origin", str(self.origin))
 
 		if self.am_selected:
-				self.element.setAttribute ("current_root", "true")
+			self.element.setAttribute ("current_root", "true")
 		else:
 			try:
 				self.element.removeAttribute ("current_root")
@@ -377,12 +535,12 @@ class DrawingThought(ResizableThought):
 			except xml.dom.NotFoundErr:
 				pass
 		doc = self.element.ownerDocument
-		for p in self.points:
-			elem = doc.createElement ("point")
+		for s in self.strokes:
+			elem = doc.createElement ("stroke")
 			self.element.appendChild (elem)
-			elem.setAttribute ("coords", str((p.x,p.y)))
-			elem.setAttribute ("type", str(p.style))
-			elem.setAttribute ("color", p.color.to_string())
+			if s.color:
+				elem.setAttribute ("color", s.color.to_string())
+			elem.appendChild (doc.createTextNode (encode_coords (s.coords)))
 		return
 
 	def load (self, node, tar):
@@ -406,10 +564,18 @@ class DrawingThought(ResizableThought):
 			else:
 				return float(attr)
 
+		def get_color (node):
+			try:
+				return Gdk.Color.parse(node.getAttribute ("color"))[1]
+			except ValueError:
+				return None
+
 		self.min_x = get_min_max(node, 'min_x')
 		self.min_y = get_min_max(node, 'min_y')
 		self.max_x = get_min_max(node, 'max_x')
 		self.max_y = get_min_max(node, 'max_y')
+		if node.hasAttribute ("origin"):
+			self.origin = utils.parse_coords (node.getAttribute ("origin"))
 
 		self.width = self.lr[0] - self.ul[0]
 		self.height = self.lr[1] - self.ul[1]
@@ -417,20 +583,23 @@ class DrawingThought(ResizableThought):
 		self.am_selected = node.hasAttribute ("current_root")
 		self.am_primary = node.hasAttribute ("primary_root")
 
+		stroke = None
 		for n in node.childNodes:
 			if n.nodeName == "Extended":
 				self.extended_buffer.load(n)
+			elif n.nodeName == "stroke":
+				data = "".join ([t.data for t in n.childNodes if t.nodeType == t.TEXT_NODE])
+				self.strokes.append (self.Stroke (decode_coords (data), get_color (n)))
 			elif n.nodeName == "point":
+				# Older maps have one element per point
 				style = int (n.getAttribute ("type"))
-				tmp = n.getAttribute ("coords")
-				c = utils.parse_coords (tmp)
-				col = None
-				try:
-					tmp = n.getAttribute ("color")
-					col = Gdk.Color.parse(tmp)[1]
-				except ValueError:
-					pass
-				self.points.append (self.DrawingPoint (c, style, col))
+				c = utils.parse_coords (n.getAttribute ("coords"))
+				if style == STYLE_BEGIN or stroke is None:
+					stroke = self.Stroke (color = get_color (n))
+					self.strokes.append (stroke)
+				stroke.coords.extend ((c[0] - self.origin[0], c[1] - self.origin[1]))
+				if style == STYLE_END:
+					stroke = None
 			else:
 				print "Unknown node type: "+str(n.nodeName)
 
@@ -439,12 +608,7 @@ class DrawingThought(ResizableThought):
 									  (move_x, move_y))
 		cwidth = context.get_line_width ()
 		context.set_line_width (1)
-		if len (self.points) > 0:
-			for p in self.points:
-				if p.style == STYLE_BEGIN:
-					context.move_to (p.x+move_x, p.y+move_y)
-				else:
-					context.line_to (p.x+move_x,p.y+move_y)
+		self.trace_strokes (context, move_x, move_y)
 
 		context.set_line_width (cwidth)
 		r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
@@ -0,0 +1,211 @@
+# ExportEngine.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Exports saved maps to PDF, SVG and PNG files in bulk.  Maps are read
+# with MapDocument, so no window is needed, and each (map, target) pair
+# is a job for a pool of processes, so all cores are kept busy.
+
+import os
+import math
+import time
+import logging
+import itertools
+import traceback
+import multiprocessing
+import cairo
+
+import MapDocument
+import TileExport
+
+FORMATS = ('pdf', 'svg', 'png')
+
+# Map coordinates are taken as points, so at this resolution one map
+# pixel is one point or one PNG pixel
+NATIVE_DPI = 72
+
+class ExportTarget:
+    ''' One kind of file to make from each map.  dpi scales the map, for \
+        PDF and SVG that makes it bigger on paper.  With a page_size \
+        (width, height), in points for PDF and SVG or in pixels for PNG, \
+        the map is split into pages: a PDF gets one page each, SVG and \
+        PNG one file each.  The pages at the right and bottom edges are \
+        cut to what is left of the map '''
+
+    def __init__(self, format, dpi = NATIVE_DPI, page_size = None):
+        if format not in FORMATS:
+            raise ValueError ("Unknown export format: %s" % format)
+        self.format = format
+        self.dpi = dpi
+        self.page_size = page_size
+
+    def __repr__(self):
+        return "ExportTarget(%r, %r, %r)" % (self.format, self.dpi, self.page_size)
+
+    def output_name (self, base, page = None):
+        ''' The file written for the map named base, or for one of its \
+            pages when the target is split into several files '''
+        name = base
+        if self.dpi != NATIVE_DPI:
+            name += "-%ddpi" % self.dpi
+        if page is not None:
+            name += "-%d" % (page + 1)
+        return name + "." + self.format
+
+class ExportResult:
+    ''' What came of one job: the files written, the time it took and, \
+        if it failed, the error '''
+
+    def __init__(self, filename, target, outputs, seconds, error = None):
+        self.filename = filename
+        self.target = target
+        self.outputs = outputs
+        self.seconds = seconds
+        self.error = error
+
+class View:
+    ''' Part of a map, scaled, with an export () like MMapArea's: what \
+        it draws at (0, 0) is the point (x, y) of the scaled map '''
+
+    def __init__(self, area, scale, x, y, map_size):
+        self.area = area
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self.map_size = map_size
+
+    def export (self, context, width, height, native):
+        context.save ()
+        context.set_source_rgb (1.0, 1.0, 1.0)
+        context.paint ()
+        context.translate (-self.x, -self.y)
+        context.scale (self.scale, self.scale)
+        self.area.export (context, self.map_size[0], self.map_size[1], native)
+        context.restore ()
+
+def page_grid (width, height, page_size):
+    ''' Returns the (x, y, width, height) of the pages covering an area \
+        of width x height, row by row '''
+    if not page_size:
+        return [(0, 0, width, height)]
+    page_width, page_height = [max (1, int (n)) for n in page_size]
+    return [(x, y, min (page_width, width - x), min (page_height, height - y))
+            for y in xrange (0, height, page_height)
+            for x in xrange (0, width, page_width)]
+
+def render (area, target, base):
+    ''' Writes area (a MapDocument or MMapArea) as target to the files \
+        named after base.  Returns the names of the files written '''
+    map_size = area.get_max_area ()
+    scale = target.dpi / float (NATIVE_DPI)
+    width = max (1, int (math.ceil (map_size[0] * scale)))
+    height = max (1, int (math.ceil (map_size[1] * scale)))
+    pages = page_grid (width, height, target.page_size)
+    outputs = []
+
+    if target.format == 'pdf':
+        filename = target.output_name (base)
+        surface = cairo.PDFSurface (filename, pages[0][2], pages[0][3])
+        context = cairo.Context (surface)
+        for x, y, page_width, page_height in pages:
+            surface.set_size (page_width, page_height)
+            View (area, scale, x, y, map_size).export (context, page_width, page_height, False)
+            context.show_page ()
+        surface.finish ()
+        outputs.append (filename)
+        return outputs
+
+    for i, (x, y, page_width, page_height) in enumerate (pages):
+        if len (pages) > 1:
+            filename = target.output_name (base, i)
+        else:
+            filename = target.output_name (base)
+        view = View (area, scale, x, y, map_size)
+        if target.format == 'svg':
+            surface = cairo.SVGSurface (filename, page_width, page_height)
+            view.export (cairo.Context (surface), page_width, page_height, False)
+            surface.finish ()
+        else:
+            TileExport.export_png (view, filename, page_width, page_height, False)
+        outputs.append (filename)
+    return outputs
+
+# The map a worker process loaded last, so the targets of a map that
+# come to the same worker one after the other load it once
+loaded = (None, None)
+
+def export_job (job):
+    ''' Runs in a worker process: loads the map of job if needed and \
+        renders one target.  Errors are returned, not raised, so one bad \
+        map doesn't stop the others '''
+    global loaded
+    filename, target, base = job
+    start = time.time ()
+    try:
+        if loaded[0] != filename:
+            loaded = (None, None)
+            loaded = (filename, MapDocument.load (filename))
+        outputs = render (loaded[1], target, base)
+        return ExportResult (filename, target, outputs, time.time () - start)
+    except Exception, e:
+        logging.error ("Exporting %s failed: %s" % (filename, e))
+        return ExportResult (filename, target, [], time.time () - start,
+                             traceback.format_exc ())
+
+class ExportEngine:
+    ''' Exports maps to a list of targets in a pool of processes, by \
+        default one for each core.  With one process everything happens \
+        in this one.  progress, if given, is called as progress (done, \
+        total, result) after each job, in the order jobs finish '''
+
+    def __init__(self, targets, processes = None, progress = None):
+        self.targets = targets
+        self.processes = processes or multiprocessing.cpu_count ()
+        self.progress = progress
+
+    def jobs (self, filenames, directory):
+        jobs = []
+        for filename in filenames:
+            name = os.path.splitext (os.path.basename (filename))[0]
+            base = os.path.join (directory or os.path.dirname (filename), name)
+            for target in self.targets:
+                jobs.append ((filename, target, base))
+        return jobs
+
+    def run (self, filenames, directory = None):
+        ''' Exports each of filenames, writing the files next to them or \
+            into directory.  Returns the ExportResults, in the order the \
+            jobs finished '''
+        jobs = self.jobs (filenames, directory)
+        if self.processes == 1 or len (jobs) == 1:
+            return self.collect (jobs, itertools.imap (export_job, jobs))
+
+        pool = multiprocessing.Pool (self.processes)
+        try:
+            return self.collect (jobs, pool.imap_unordered (export_job, jobs))
+        finally:
+            pool.close ()
+            pool.join ()
+
+    def collect (self, jobs, results):
+        done = []
+        for result in results:
+            done.append (result)
+            if self.progress:
+                self.progress (len (done), len (jobs), result)
+        return done
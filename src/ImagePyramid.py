@@ -0,0 +1,122 @@
+# ImagePyramid.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import threading
+from collections import OrderedDict
+
+from gi.repository import GdkPixbuf
+
+# Levels stop once they would be smaller than this on either side
+MIN_LEVEL_SIZE = 32
+
+# How many exact sizes are kept, for thoughts sharing the picture
+MAX_EXACT = 4
+
+# Interpolation types, from the cheapest to the best looking
+QUALITY = [GdkPixbuf.InterpType.NEAREST, GdkPixbuf.InterpType.TILES,
+           GdkPixbuf.InterpType.BILINEAR, GdkPixbuf.InterpType.HYPER]
+
+class ImagePyramid:
+    ''' Copies of a picture at half, quarter, ... of its size.  Scaling \
+        starts from the smallest level that is still at least as big as \
+        the size wanted, so shrinking a large photo doesn't have to go \
+        over all of its pixels every time.  Levels are made on demand, \
+        each from the one above it.  The last few exact sizes asked for \
+        are kept, as that is what the thoughts showing the picture keep \
+        drawing.  Scaling may happen in a worker thread while the main \
+        loop draws'''
+
+    def __init__(self, pixbuf):
+        self.levels = [pixbuf]
+        # (width, height) -> (quality, pixbuf), most recently used last
+        self.exact = OrderedDict()
+        self.lock = threading.Lock()
+
+    def original (self):
+        return self.levels[0]
+
+    def level (self, width, height):
+        ''' Returns the smallest level at least width x height big '''
+        with self.lock:
+            return self.find_level(width, height)
+
+    def find_level (self, width, height):
+        i = 0
+        while True:
+            if i + 1 == len(self.levels) and not self.add_level():
+                return self.levels[i]
+            below = self.levels[i + 1]
+            if below.get_width() < width or below.get_height() < height:
+                return self.levels[i]
+            i += 1
+
+    def add_level (self):
+        last = self.levels[-1]
+        width = last.get_width() / 2
+        height = last.get_height() / 2
+        if width < MIN_LEVEL_SIZE or height < MIN_LEVEL_SIZE:
+            return False
+        self.levels.append(last.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR))
+        return True
+
+    def nbytes (self):
+        ''' Memory taken by the pixels of all levels and exact sizes '''
+        with self.lock:
+            pixbufs = list(self.levels)
+            for quality, pixbuf in self.exact.itervalues():
+                if pixbuf not in pixbufs:
+                    pixbufs.append(pixbuf)
+        return sum([p.get_rowstride() * p.get_height() for p in pixbufs])
+
+    def cached (self, width, height, interp = GdkPixbuf.InterpType.HYPER):
+        ''' Returns the picture at width x height if it has been scaled \
+            to that size with at least the quality of interp already, \
+            otherwise None '''
+        key = (int(width), int(height))
+        with self.lock:
+            exact = self.exact.pop(key, None)
+            if exact is None:
+                return None
+            self.exact[key] = exact
+        if exact[0] >= QUALITY.index(interp):
+            return exact[1]
+        return None
+
+    def scaled (self, width, height, interp = GdkPixbuf.InterpType.HYPER):
+        ''' Returns the picture scaled to exactly width x height '''
+        width = int(width)
+        height = int(height)
+        pixbuf = self.cached(width, height, interp)
+        if pixbuf:
+            return pixbuf
+        source = self.level(width, height)
+        if source.get_width() == width and source.get_height() == height:
+            pixbuf = source
+        else:
+            # Not holding the lock, this is the slow part
+            pixbuf = source.scale_simple(width, height, interp)
+        with self.lock:
+            exact = self.exact.pop((width, height), None)
+            # Keep the better looking one if another thread got there first
+            if exact is None or exact[0] < QUALITY.index(interp):
+                exact = (QUALITY.index(interp), pixbuf)
+            self.exact[(width, height)] = exact
+            while len(self.exact) > MAX_EXACT:
+                self.exact.popitem(last=False)
+        return exact[1]
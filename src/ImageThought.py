@@ -25,6 +25,7 @@ import gettext
 _ = gettext.gettext
 import cairo
 import os
+import hashlib
 import logging
 import tempfile
 import cStringIO
@@ -37,10 +38,33 @@ from sugar3 import mime
 from BaseThought import *
 import utils
 import UndoManager
+import ImagePyramid
+import WorkerPool
+from PictureCache import pictures
+from port.tarball import decode_pixbuf, encode_pixbuf
 
 from sugar3.activity.activity import get_activity_root
 from sugar3.graphics.objectchooser import ObjectChooser
 
+def picture_extension (path):
+    # Journal files often have no extension of their own
+    info = GdkPixbuf.Pixbuf.get_file_info (path)
+    if info and info[0]:
+        return '.' + info[0].get_extensions ()[0]
+    return os.path.splitext (path)[1] or '.png'
+
+def decode_and_scale (data, width, height):
+    # Runs in a worker thread
+    pyramid = ImagePyramid.ImagePyramid (decode_pixbuf (data))
+    pyramid.scaled (width, height)
+    return pyramid
+
+def picture_decoded (key, pyramid):
+    if pyramid:
+        pictures.pyramids[key] = pyramid
+    for thought, job in pictures.decoding.pop (key, []):
+        thought.picture_decoded (pyramid, job)
+
 class ImageThought (ResizableThought):
     def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
         super (ImageThought, self).__init__(coords, save, "image_thought", undo, background_color, foreground_color)
@@ -48,11 +72,29 @@ class ImageThought (ResizableThought):
         self.identity = thought_number
         self.pic = None
         self.orig_pic = None
+        self.pyramid = None
+        # The picture as stored in the map, and the hash naming it there.
+        # Pictures with these around are only decoded while in view, see
+        # picture_in_view
+        self.pic_data = None
+        self.pic_hash = None
+        self.decoding = False
+        # Results of background jobs started before the latest are stale
+        self.pic_job = 0
+        self.export_cache = None
         self.pic_location = coords
         self.button_press = False
         self.all_okay = True
         self.object_chooser_active = False
 
+    def memory_size (self):
+        size = ResizableThought.memory_size (self)
+        if self.pic_data:
+            size += len (self.pic_data)
+        if self.pyramid:
+            size += self.pyramid.nbytes ()
+        return size
+
     # FIXME: Work in progress, needs at least activity self to create
     # tmp files/links in the right places and reference the window.
     def journal_open_image (self):
@@ -73,8 +115,14 @@ class ImageThought (ResizableThought):
             if jobject and jobject.file_path:
                 logging.debug("journal_open_image: fname=%s" % jobject.file_path)
                 try:
-                    self.orig_pic = GdkPixbuf.Pixbuf.new_from_file(jobject.file_path)
-                    self.filename = os.path.join('images', os.path.basename(jobject.file_path))
+                    f = open(jobject.file_path, 'rb')
+                    data = f.read()
+                    f.close()
+                    self.set_picture (decode_pixbuf(data))
+                    # Keep the file as it is, a photo saved as PNG
+                    # would be several times bigger
+                    self.set_picture_data (data, picture_extension(jobject.file_path))
+                    name = os.path.join('images', os.path.basename(jobject.file_path))
                 except Exception, e:
                     logging.error("journal_open_image: %s" % e)
                     return False
@@ -85,48 +133,201 @@ class ImageThought (ResizableThought):
             del chooser
         self.object_chooser_active = False
 
-        self.text = self.filename[0:self.filename.rfind('.')]
+        self.text = name[0:name.rfind('.')]
         self.recalc_edges(True)
 
         return True
 
+    def set_picture (self, pixbuf):
+        # Pictures without data to decode them from again (set_picture_data)
+        # stay out of the picture cache
+        self.orig_pic = pixbuf
+        self.pyramid = ImagePyramid.ImagePyramid (pixbuf)
+        self.pic_data = None
+        self.pic_hash = None
+
+    def set_picture_data (self, data, ext):
+        # Pictures are stored under the hash of their data, so the same
+        # picture used by several thoughts is saved and decoded only once
+        self.pic_data = data
+        self.pic_hash = hashlib.sha1 (data).hexdigest ()
+        self.filename = os.path.join ('images', self.pic_hash + ext)
+        if self.pyramid and self.pic_hash not in pictures.pyramids:
+            pictures.pyramids[self.pic_hash] = self.pyramid
+
+    def ensure_picture_data (self):
+        if not self.pic_data and self.orig_pic:
+            self.set_picture_data (encode_pixbuf (self.orig_pic), '.png')
+
+    def use_pyramid (self, pyramid, scale=GdkPixbuf.InterpType.HYPER):
+        self.orig_pic = pyramid.original ()
+        self.pyramid = pyramid
+        self.recalc_edges (False, scale)
+        pictures.touch (self, pyramid.nbytes ())
+
+    def picture_size (self):
+        margin = utils.margin_required (utils.STYLE_NORMAL)
+        return (int (max(MIN_SIZE, self.width - margin[0] - margin[2])),
+                int (max(MIN_SIZE, self.height - margin[1] - margin[3])))
+
+    def picture_in_view (self):
+        if self.pyramid:
+            if self.pic_data:
+                pictures.touch (self, self.pyramid.nbytes ())
+        elif self.pic_data and not self.decoding:
+            pyramid = pictures.pyramids.get (self.pic_hash)
+            if pyramid:
+                self.use_pyramid (pyramid)
+            else:
+                self.decode_in_background ()
+
+    def drop_picture (self):
+        ''' Frees the decoded pixels, keeping what is needed to decode \
+            them again '''
+        self.pic_job += 1
+        self.decoding = False
+        self.orig_pic = None
+        self.pyramid = None
+        self.pic = None
+        self.export_cache = None
+
+    def decode_in_background (self):
+        self.decoding = True
+        self.pic_job += 1
+        key = self.pic_hash
+        if key in pictures.decoding:
+            # Another thought is decoding the same picture already
+            pictures.decoding[key].append ((self, self.pic_job))
+            return
+        pictures.decoding[key] = [(self, self.pic_job)]
+        width, height = self.picture_size ()
+        WorkerPool.get_pool ().submit (lambda pyramid: picture_decoded (key, pyramid),
+                                       decode_and_scale, self.pic_data, width, height)
+
+    def picture_decoded (self, pyramid, job):
+        if job != self.pic_job:
+            return
+        self.decoding = False
+        # On errors the placeholder stays, and the data is saved as it was
+        if not pyramid:
+            return
+        self.use_pyramid (pyramid)
+        self.emit ("update_view")
+
+    def wait_for_picture (self):
+        ''' Decodes the picture now, if that is still to happen '''
+        if self.pic_data and not self.pyramid:
+            self.pic_job += 1
+            self.decoding = False
+            pyramid = pictures.pyramids.get (self.pic_hash)
+            if not pyramid:
+                pyramid = ImagePyramid.ImagePyramid (decode_pixbuf (self.pic_data))
+                pictures.pyramids[self.pic_hash] = pyramid
+            self.use_pyramid (pyramid, GdkPixbuf.InterpType.BILINEAR)
+
+    def scale_in_background (self, width, height):
+        self.pic_job += 1
+        job = self.pic_job
+        WorkerPool.get_pool ().submit (lambda pic: self.picture_scaled (pic, job),
+                                       self.pyramid.scaled, width, height)
+
+    def picture_scaled (self, pic, job):
+        if job != self.pic_job or not pic:
+            return
+        if (pic.get_width (), pic.get_height ()) == self.picture_size ():
+            self.pic = pic
+            self.emit ("update_view")
+
     def draw (self, context):
         ResizableThought.draw(self, context)
+        self.picture_in_view ()
+        if not self.pic and self.pic_data:
+            # Still being decoded, show where the picture will be
+            width, height = self.picture_size ()
+            context.rectangle (self.pic_location[0], self.pic_location[1], width, height)
+            context.set_source_rgb (0.85, 0.85, 0.85)
+            context.fill ()
         if self.pic:
-            context.set_source_pixbuf (self.pic, self.pic_location[0], self.pic_location[1])
-            context.rectangle (self.pic_location[0], self.pic_location[1], self.width, self.height)
+            width = self.pic.get_width ()
+            height = self.pic.get_height ()
+            pic = self.pic
+            # When zoomed out, a smaller copy of the picture will do
+            scale = context.get_matrix ().xx
+            if scale < 1:
+                level = self.pyramid.level (width * scale, height * scale)
+                if level.get_width () < width:
+                    pic = level
+            context.save ()
+            context.translate (self.pic_location[0], self.pic_location[1])
+            context.scale (float (width) / pic.get_width (), float (height) / pic.get_height ())
+            Gdk.cairo_set_source_pixbuf (context, pic, 0, 0)
+            context.rectangle (0, 0, pic.get_width (), pic.get_height ())
             context.fill ()
+            context.restore ()
         context.set_source_rgb (0,0,0)
 
+    def render_key (self):
+        # Asked for on every redraw of the thought, even when the render
+        # cache has it, so this is where to notice it is in view
+        self.picture_in_view ()
+        key = ResizableThought.render_key (self)
+        if key is None:
+            return None
+        return key + (self.pic,)
+
     def export (self, context, move_x, move_y):
         utils.export_thought_outline (context, self.ul, self.lr, self.background_color, self.am_selected, self.am_primary, utils.STYLE_NORMAL,
                                       (move_x, move_y))
-        if self.pic:
-            raw_pixels = self.pic.get_pixels_array()
+        self.wait_for_picture ()
+        if not self.pic:
+            width, height = self.picture_size ()
+            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, width, height)
+            context.set_source_rgb (0.85, 0.85, 0.85)
+            context.fill ()
+        else:
+            width = self.pic.get_width ()
+            height = self.pic.get_height ()
             if hasattr(context, "set_source_pixbuf"):
                 context.set_source_pixbuf (self.pic, self.pic_location[0]+move_x, self.pic_location[1]+move_y)
             elif hasattr(context, "set_source_surface"):
-                pixel_array = utils.pixbuf_to_cairo (raw_pixels)
-                image_surface = cairo.ImageSurface.create_for_data(pixel_array, cairo.FORMAT_ARGB32, len(raw_pixels[0]), len(raw_pixels), -1)
-                context.set_source_surface (image_surface, self.pic_location[0]+move_x, self.pic_location[1]+move_y)
-                
-            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, len(raw_pixels[0]), len(raw_pixels))
+                context.set_source_surface (self.export_surface (), self.pic_location[0]+move_x, self.pic_location[1]+move_y)
+
+            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, width, height)
             context.fill ()
         context.set_source_rgb (0,0,0)
 
+    def export_surface (self):
+        # Converting the pixels is slow, so keep the surface until the
+        # picture is scaled again
+        if self.export_cache and self.export_cache[0] is self.pic:
+            return self.export_cache[2]
+        width = self.pic.get_width ()
+        pixel_array = utils.pixbuf_to_cairo (self.pic)
+        image_surface = cairo.ImageSurface.create_for_data (pixel_array, cairo.FORMAT_ARGB32,
+                                                           width, self.pic.get_height (), width * 4)
+        # The surface uses pixel_array's memory, so hold on to both
+        self.export_cache = (self.pic, pixel_array, image_surface)
+        return image_surface
+
     def recalc_edges (self, force=False, scale=GdkPixbuf.InterpType.HYPER):
         self.lr = (self.ul[0]+self.width, self.ul[1]+self.height)
 
         margin = utils.margin_required (utils.STYLE_NORMAL)
         self.pic_location = (self.ul[0]+margin[0], self.ul[1]+margin[1])
 
-        pic_w = max(MIN_SIZE, self.width - margin[0] - margin[2])
-        pic_h = max(MIN_SIZE, self.height - margin[1] - margin[3])
+        pic_w, pic_h = self.picture_size ()
 
         if self.orig_pic and (force or not self.pic or self.pic.get_width() != pic_w
                 or self.pic.get_height() != pic_h):
-                        self.pic = self.orig_pic.scale_simple(int(pic_w),
-                                  int(pic_h), scale)
+            pic = self.pyramid.cached (pic_w, pic_h, scale)
+            if pic:
+                self.pic = pic
+            elif scale == GdkPixbuf.InterpType.HYPER:
+                # Show a quick scale until the good looking one is done
+                self.pic = self.pyramid.scaled (pic_w, pic_h, GdkPixbuf.InterpType.NEAREST)
+                self.scale_in_background (pic_w, pic_h)
+            else:
+                self.pic = self.pyramid.scaled (pic_w, pic_h, scale)
 
 
     def process_button_down (self, event, coords):
@@ -164,7 +365,14 @@ class ImageThought (ResizableThought):
 
         return False
 
+    def save_key (self):
+        # The file name is only known once there is data to save
+        self.ensure_picture_data ()
+        return ResizableThought.save_key (self) + (self.filename,)
+
     def update_save (self):
+        # The file name depends on the data
+        self.ensure_picture_data ()
         text = self.extended_buffer.get_text ()
         if text:
             self.extended_buffer.update_save()
@@ -196,8 +404,10 @@ class ImageThought (ResizableThought):
                 pass
 
     def save (self, tar):
-        if not [i for i in tar.getnames() if i == self.filename]:
-            tar.write(self.filename, self.orig_pic)
+        # Pictures already in the archive are written as they were read
+        self.ensure_picture_data ()
+        if not tar.exists(self.filename):
+            tar.write(self.filename, self.pic_data)
 
     def load (self, node, tar):
         tmp = node.getAttribute ("ul-coords")
@@ -226,9 +436,14 @@ class ImageThought (ResizableThought):
                 print "Unknown: "+n.nodeName
         margin = utils.margin_required (utils.STYLE_NORMAL)
         self.pic_location = (self.ul[0]+margin[0], self.ul[1]+margin[1])
-        self.orig_pic = tar.read_pixbuf(self.filename)
         self.lr = (self.pic_location[0]+self.width+margin[2], self.pic_location[1]+self.height+margin[3])
         self.recalc_edges()
+        # Only read the file here, it is decoded once it comes into view.
+        # Maps read without their archive (a bare MANIFEST) have no
+        # pictures, those thoughts show a placeholder
+        if tar is not None:
+            self.set_picture_data (tar.read(self.filename),
+                                   os.path.splitext(self.filename)[1] or '.png')
     
     def enter (self):
         self.editing = True
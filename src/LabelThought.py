@@ -72,6 +72,12 @@ class LabelThought (TextThought):
         context.set_source_rgb (0,0,0)
         context.stroke ()
 
+    def render_key (self):
+        key = TextThought.render_key (self)
+        if key is None:
+            return None
+        return key + (self.edge,)
+
     def update_save (self):
         next = self.element.firstChild
         while next:
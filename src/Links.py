@@ -55,6 +55,7 @@ class Link (GObject.GObject):
         self.color = utils.gtk_to_cairo_color(Gdk.Color.parse("black"))
         self.model_iter = None
         self.text = None
+        self.xml_cache = None
 
         if not self.start and parent and parent.lr:
             self.start = (parent.ul[0]-((parent.ul[0]-parent.lr[0]) / 2.), \
@@ -176,6 +177,14 @@ class Link (GObject.GObject):
         if self.parent and self.child:
             self.find_ends ()
 
+    def save_key (self):
+        return (self.start, self.end, self.strength, self.color,
+                self.parent and self.parent.identity,
+                self.child and self.child.identity)
+
+    def mark_dirty (self, *args):
+        self.xml_cache = None
+
     def update_save (self):
         self.element.setAttribute ("start", str(self.start))
         self.element.setAttribute ("end", str(self.end))
@@ -278,6 +287,7 @@ class Link (GObject.GObject):
     def color_selection_ok_cb(self, dialog, response_id):
         if response_id == Gtk.ResponseType.OK:
             self.color = utils.gtk_to_cairo_color(self.color_sel.get_current_color())
+            self.emit ("update_view")
 
         dialog.destroy()
 
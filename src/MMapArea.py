@@ -30,6 +30,7 @@ import logging
 _ = gettext.gettext
 
 import xml.dom.minidom as dom
+from xml.sax import saxutils
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -43,9 +44,13 @@ import ImageThought
 import DrawingThought
 import ResourceThought
 import UndoManager
+import SpatialIndex
+import RenderCache
 import utils
-from BaseThought import BaseThought
+from PictureCache import pictures
+from BaseThought import BaseThought, UNDO_RESIZE, combine_resizes
 from Links import Link
+from MapModel import MapModel
 
 RAD_UP = (- math.pi / 2.)
 RAD_DOWN = (math.pi / 2.)
@@ -62,6 +67,10 @@ MODE_LABEL       = 5
 VIEW_LINES = 0
 VIEW_BEZIER = 1
 
+# Extra pixels redrawn around a damaged area, covering antialiasing and
+# rounding to whole pixels
+DAMAGE_MARGIN = 2
+
 # TODO: Need to expand to support popup menus
 MENU_EMPTY_SPACE = 0
 
@@ -75,6 +84,34 @@ UNDO_DELETE_LINK = 5
 UNDO_STRENGTHEN_LINK = 6
 UNDO_CREATE_LINK = 7
 UNDO_ALIGN = 8
+UNDO_TRANSACTION = 9
+
+# Coalescing rules for the undo actions above, see UndoManager.add_rule.
+# Bursts of the same change to the same objects undo in one go
+
+def combine_moves (back, action):
+    ''' Drags of the same thoughts: one move by the distance of them all '''
+    if not UndoManager.in_burst (back, action) or set (back.args[1]) != set (action.args[1]):
+        return None
+    end = (back.args[2][0] + action.args[2][0] - action.args[0][0],
+           back.args[2][1] + action.args[2][1] - action.args[0][1])
+    return UndoManager.UndoAction (action.owner, UNDO_MOVE, action.callback, back.args[0], action.args[1], end)
+
+def combine_aligns (back, action):
+    ''' Alignments of the same thoughts: each moved by the sum of its moves '''
+    if not UndoManager.in_burst (back, action) or set (back.args[0]) != set (action.args[0]):
+        return None
+    dic = {}
+    for t, vec in back.args[0].iteritems ():
+        dic[t] = (vec[0] + action.args[0][t][0], vec[1] + action.args[0][t][1])
+    return UndoManager.UndoAction (action.owner, UNDO_ALIGN, action.callback, dic)
+
+def combine_strengths (back, action):
+    ''' Strength changes of the same link: from the first strength to the last '''
+    if not UndoManager.in_burst (back, action) or back.args[0] is not action.args[0]:
+        return None
+    return UndoManager.UndoAction (action.owner, UNDO_STRENGTHEN_LINK, action.callback, action.args[0],
+                                   back.args[1], action.args[2])
 
 # Note: This is (atm) very broken.  It will allow you to create new canvases, but not
 # create new thoughts or load existing maps.
@@ -82,7 +119,7 @@ UNDO_ALIGN = 8
 # necessary features within all the thought types.  If you do, please send a patch ;)
 # OR: Change this class to MMapAreaNew and MMapAreaOld to MMapArea
 
-class MMapArea (Gtk.DrawingArea):
+class MMapArea (Gtk.DrawingArea, MapModel):
     '''A MindMapArea Widget.  A blank canvas with a collection of child thoughts.\
        It is responsible for processing signals and such from the whole area and \
        passing these on to the correct child.  It also informs things when to draw'''
@@ -124,6 +161,10 @@ class MMapArea (Gtk.DrawingArea):
         self.primary = None
         self.pango_context = self.create_pango_context()
         self.undo = undo
+        self.undo.add_rule (UNDO_MOVE, combine_moves)
+        self.undo.add_rule (UNDO_ALIGN, combine_aligns)
+        self.undo.add_rule (UNDO_STRENGTHEN_LINK, combine_strengths)
+        self.undo.add_rule (UNDO_RESIZE, combine_resizes)
         self.scale_fac = 1.0
         self.translate = False
         self.translation = [0.0,0.0]
@@ -131,6 +172,23 @@ class MMapArea (Gtk.DrawingArea):
         self.current_cursor = None
         self.do_filter = True
         self.is_bbox_selecting = False
+        self.thought_index = SpatialIndex.SpatialIndex()
+        self.link_index = SpatialIndex.SpatialIndex()
+        self.render_cache = RenderCache.RenderCache()
+        self.thoughts_by_id = {}
+        self.links_by_thought = {}
+        self.link_pairs = {}
+        self.hover = None
+        # While damage_holds > 0, invalidate collects areas in held_damage
+        self.damage_holds = 0
+        self.held_damage = []
+        # Open transactions, and what they put off until the last commits:
+        # thoughts whose links need new ends, and top level elements to
+        # be in the document (True) or not (False)
+        self.transactions = 0
+        self.pending_links = set ()
+        self.pending_elements = {}
+        self.pending_order = []
 
         self.nthoughts = 0
 
@@ -265,20 +323,24 @@ class MMapArea (Gtk.DrawingArea):
 
     def undo_move (self, action, mode):
         self.undo.block ()
-        move_thoughts = action.args[1]
-        old_coords = action.args[0]
-        new_coords = action.args[2]
-        move_x = old_coords[0] - new_coords[0]
-        move_y = old_coords[1] - new_coords[1]
-        if mode == UndoManager.REDO:
-            move_x = -move_x
-            move_y = -move_y
-        self.unselect_all ()
-        for t in move_thoughts:
-            self.select_thought (t, -1)
-            t.move_by (move_x, move_y)
-        self.undo.unblock ()
-        self.invalidate ((old_coords[0], old_coords[1], new_coords[0], new_coords[1]))
+        self.begin_transaction ()
+        try:
+            move_thoughts = action.args[1]
+            old_coords = action.args[0]
+            new_coords = action.args[2]
+            move_x = old_coords[0] - new_coords[0]
+            move_y = old_coords[1] - new_coords[1]
+            if mode == UndoManager.REDO:
+                move_x = -move_x
+                move_y = -move_y
+            self.unselect_all ()
+            for t in move_thoughts:
+                self.select_thought (t, -1)
+                t.move_by (move_x, move_y)
+            self.invalidate ((old_coords[0], old_coords[1], new_coords[0], new_coords[1]))
+        finally:
+            self.undo.unblock ()
+            self.commit_transaction ()
 
     def button_release (self, widget, event):
         if self._dragging:
@@ -405,8 +467,11 @@ class MMapArea (Gtk.DrawingArea):
         coords = self.transform_coords (event.get_coords()[0], event.get_coords()[1])
 
         if event.state & Gdk.ModifierType.BUTTON1_MASK and self.is_bbox_selecting:
+            # Redraw the old and new rubber band, the band itself is 2 units wide
+            if hasattr(self, "bbox_current"):
+                self.damage (self.bbox_area ())
             self.bbox_current = coords
-            self.invalidate()
+            self.damage (self.bbox_area ())
 
             ul = [ self.bbox_origin[0], self.bbox_origin[1] ]
             lr = [ coords[0], coords[1] ]
@@ -425,25 +490,28 @@ class MMapArea (Gtk.DrawingArea):
                 lr[0] = coords[0]
                 lr[1] = self.bbox_origin[1]
 
-            # FIXME: O(n) runtime is bad
-            for t in self.thoughts:
-                if t.lr[0] > ul[0] and t.ul[1] < lr[1] and t.ul[0] < lr[0] and t.lr[1] > ul[1] :
-                    if t not in self.selected:
-                        self.select_thought(t, Gdk.ModifierType.SHIFT_MASK)
-                else:
-                    if t in self.selected:
-                        t.unselect()
-                        self.selected.remove(t)
+            inside = [t for t in self.thought_index.query_rect(ul[0], ul[1], lr[0], lr[1]) \
+                      if t.ul and t.lr and t.lr[0] > ul[0] and t.ul[1] < lr[1] and \
+                      t.ul[0] < lr[0] and t.lr[1] > ul[1]]
+            inside_set = set(inside)
+            for t in [x for x in self.selected if x not in inside_set and x in self.thought_index]:
+                t.unselect()
+                self.selected.remove(t)
+                self.damage_object(t)
+            selected = set(self.selected)
+            for t in inside:
+                if t not in selected:
+                    self.select_thought(t, Gdk.ModifierType.SHIFT_MASK)
             return True
         elif self.moving:
             self.set_cursor(Gdk.CursorType.FLEUR)
             if not self.move_action:
                 self.move_action = UndoManager.UndoAction (self, UNDO_MOVE, self.undo_move, self.move_origin,
-                                                           self.selected)
+                                                           copy.copy(self.selected))
+            # move_by reports the old and new areas through update_view
             for t in self.selected:
                 t.move_by (coords[0] - self.move_origin_new[0], coords[1] - self.move_origin_new[1])
             self.move_origin_new = (coords[0], coords[1])
-            self.invalidate ()
             return True
         elif event.state & Gdk.ModifierType.BUTTON2_MASK or \
                 event.state & Gdk.ModifierType.BUTTON1_MASK and self.translate:
@@ -466,11 +534,16 @@ class MMapArea (Gtk.DrawingArea):
     def find_object_at (self, coords):
         if self.focus and self.focus.includes(coords):
             return self.focus
-        for x in reversed(self.thoughts):
-            if x != self.focus and not isinstance(x, Link) and x.includes (coords):
-                return x
-        for x in self.links:
-            if x != self.focus and not isinstance(x, Link) and x.includes (coords):
+        candidates = self.thought_index.query_point(coords[0], coords[1])
+        # Thoughts reset their resize state and mouse cursor when asked
+        # about a point outside of them.  Let the one the pointer was last
+        # over know it has been left, as it may not be a candidate anymore
+        if self.hover and self.hover != self.focus and self.hover not in candidates:
+            self.hover.includes(coords)
+        self.hover = None
+        for x in reversed(candidates):
+            if x != self.focus and x.includes (coords):
+                self.hover = x
                 return x
         return None
 
@@ -550,6 +623,7 @@ class MMapArea (Gtk.DrawingArea):
         self.hookup_im_context ()
         for t in self.selected:
             t.unselect ()
+            self.damage_object (t)
         self.selected = []
 
     def select_link (self, link, modifiers):
@@ -565,9 +639,12 @@ class MMapArea (Gtk.DrawingArea):
             if self.selected.count (link) == 0:
                 self.selected.append (link)
         else:
-            map (lambda t : t.unselect(), self.selected)
+            for t in self.selected:
+                t.unselect ()
+                self.damage_object (t)
             self.selected = [link]
         link.select()
+        self.damage_object (link)
         self.emit("change_buffer", None)
 
     def set_focus(self, thought, modifiers):
@@ -585,14 +662,16 @@ class MMapArea (Gtk.DrawingArea):
         if thought in self.selected and self.moving:
             return
 
-        if thought not in self.thoughts:
-            self.thoughts.append(thought)
+        if thought not in self.thought_index:
+            self.attach_thought(thought)
 
         if modifiers and (modifiers & Gdk.ModifierType.SHIFT_MASK or modifiers == -1):
             if self.selected.count (thought) == 0:
                 self.selected.append (thought)
         else:
-            map(lambda x : x.unselect(), self.selected)
+            for x in self.selected:
+                x.unselect ()
+                self.damage_object (x)
             self.selected = [thought]
         if thought.can_be_parent():
             self.current_root = []
@@ -600,6 +679,7 @@ class MMapArea (Gtk.DrawingArea):
             if x.can_be_parent():
                 self.current_root.append(x)
         thought.select ()
+        self.damage_object (thought)
         if len(self.selected) == 1:
             self.emit ("thought_selection_changed", thought.background_color, thought.foreground_color)
             self.background_color = thought.background_color
@@ -614,44 +694,59 @@ class MMapArea (Gtk.DrawingArea):
 
     def undo_link_action (self, action, mode):
         self.undo.block ()
-        self.set_focus(None, None)
-        link = action.args[0]
-        if action.undo_type == UNDO_CREATE_LINK:
-            if mode == UndoManager.REDO:
-                self.element.appendChild (link.element)
-                self.links.append (link)
-            else:
-                self.delete_link (link)
-        elif action.undo_type == UNDO_DELETE_LINK:
-            if mode == UndoManager.UNDO:
-                self.element.appendChild (link.element)
-                self.links.append (link)
-            else:
-                self.delete_link (link)
-        elif action.undo_type == UNDO_STRENGTHEN_LINK:
-            if mode == UndoManager.UNDO:
-                link.set_strength (action.args[1])
-            else:
-                link.set_strength (action.args[2])
-
-        self.undo.unblock ()
-        self.invalidate ()
+        self.hold_damage ()
+        try:
+            self.set_focus(None, None)
+            link = action.args[0]
+            if action.undo_type == UNDO_CREATE_LINK:
+                if mode == UndoManager.REDO:
+                    self.add_element (link.element)
+                    self.attach_link (link)
+                else:
+                    self.delete_link (link)
+            elif action.undo_type == UNDO_DELETE_LINK:
+                if mode == UndoManager.UNDO:
+                    self.add_element (link.element)
+                    self.attach_link (link)
+                else:
+                    self.delete_link (link)
+            elif action.undo_type == UNDO_STRENGTHEN_LINK:
+                if mode == UndoManager.UNDO:
+                    link.set_strength (action.args[1])
+                else:
+                    link.set_strength (action.args[2])
+                self.reindex_link (link)
+            self.invalidate ()
+        finally:
+            self.undo.unblock ()
+            self.release_damage ()
 
     def connect_link (self, link):
         link.connect ("select_link", self.select_link)
         link.connect ("update_view", self.update_view)
 
     def create_link (self, thought, thought_coords, child, child_coords = None, strength = 2):
-        for x in self.links:
-            if x.connects (thought, child):
-                if x.change_strength (thought, child):
-                    self.delete_link (x)
-                return
+        x = self.find_link (thought, child)
+        if x:
+            old_strength = x.strength
+            if x.change_strength (thought, child):
+                # Linking linked thoughts again unlinks them.  The link is
+                # deleted with the strength it had, so undoing brings it
+                # back as it was
+                x.set_strength (old_strength)
+                self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DELETE_LINK, self.undo_link_action, x))
+                self.damage_object (x)
+                self.delete_link (x)
+            else:
+                self.undo.add_undo (UndoManager.UndoAction (self, UNDO_STRENGTHEN_LINK, self.undo_link_action,
+                                                            x, old_strength, x.strength))
+                self.damage (*self.reindex_link (x))
+            return
         link = Link (self.save, parent = thought, child = child, strength = strength)
         self.connect_link (link)
         element = link.get_save_element ()
-        self.element.appendChild (element)
-        self.links.append (link)
+        self.add_element (element)
+        self.attach_link (link)
 
         return link
 
@@ -660,30 +755,226 @@ class MMapArea (Gtk.DrawingArea):
             self.set_cursor (cursor_type)
 
     def update_all_links(self):
-        map(lambda l : l.find_ends(), self.links)
+        for l in self.links:
+            l.find_ends ()
+            self.reindex_link (l)
 
     def update_links_cb (self, thought):
-        for x in self.links:
-            if x.uses (thought):
-                x.find_ends ()
+        if self.transactions:
+            self.pending_links.add (thought)
+            return
+        for x in self.links_of (thought):
+            x.find_ends ()
+            self.damage (*self.reindex_link (x))
 
     def update_view (self, thought):
-        self.invalidate ()
+        thought.mark_dirty ()
+        if isinstance(thought, Link):
+            old, new = self.reindex_link (thought)
+        else:
+            old, new = self.reindex_thought (thought)
+        if old or new:
+            self.damage (old, new)
+        else:
+            # Nothing known about where it is (yet), so play it safe
+            self.invalidate ()
+
+    def detach_thought (self, thought):
+        self.thoughts.remove (thought)
+        self.thought_index.remove (thought)
+        if self.thoughts_by_id.get (thought.identity) is thought:
+            del self.thoughts_by_id[thought.identity]
+        self.render_cache.forget (thought)
+        pictures.forget (thought)
+        if self.hover == thought:
+            self.hover = None
+
+    def attach_link (self, link):
+        self.links.append (link)
+        self.link_index.insert (link, self.link_bounds (link))
+        self.index_link_ends (link)
+
+    def detach_link (self, link):
+        self.links.remove (link)
+        self.link_index.remove (link)
+        self.unindex_link_ends (link)
+
+    def index_link_ends (self, link):
+        for t in (link.parent, link.child):
+            if t:
+                self.links_by_thought.setdefault (t, []).append (link)
+        if link.parent and link.child:
+            self.link_pairs[(link.parent, link.child)] = link
+
+    def unindex_link_ends (self, link):
+        for t in (link.parent, link.child):
+            links = self.links_by_thought.get (t)
+            if links and link in links:
+                links.remove (link)
+                if not links:
+                    del self.links_by_thought[t]
+        if self.link_pairs.get ((link.parent, link.child)) is link:
+            del self.link_pairs[(link.parent, link.child)]
+
+    def links_of (self, thought):
+        '''Returns the links using thought'''
+        return list (self.links_by_thought.get (thought, ()))
+
+    def find_link (self, thought, thought2):
+        '''Returns the link connecting the two thoughts, in either direction'''
+        return self.link_pairs.get ((thought, thought2)) or \
+               self.link_pairs.get ((thought2, thought))
+
+    def reindex_thought (self, thought):
+        '''Refreshes the index entry of thought.  Returns the area it \
+           covered before and the area it covers now'''
+        if thought not in self.thought_index:
+            return None, None
+        new = self.thought_bounds (thought)
+        return self.thought_index.update (thought, new), new
+
+    def reindex_link (self, link):
+        if link not in self.link_index:
+            return None, None
+        new = self.link_bounds (link)
+        return self.link_index.update (link, new), new
+
+    def damage (self, *areas):
+        '''Redraws the union of the given map areas (x0, y0, x1, y1).  \
+           Areas that are None are skipped'''
+        areas = [a for a in areas if a]
+        if not areas:
+            return
+        self.invalidate ((min([a[0] for a in areas]), min([a[1] for a in areas]),
+                          max([a[2] for a in areas]), max([a[3] for a in areas])))
+
+    def damage_object (self, obj):
+        if isinstance(obj, Link):
+            self.damage (self.link_index.get_bounds (obj))
+        else:
+            self.damage (self.thought_index.get_bounds (obj))
+
+    def bbox_area (self):
+        return (min(self.bbox_origin[0], self.bbox_current[0]) - 2,
+                min(self.bbox_origin[1], self.bbox_current[1]) - 2,
+                max(self.bbox_origin[0], self.bbox_current[0]) + 2,
+                max(self.bbox_origin[1], self.bbox_current[1]) + 2)
+
+    def hold_damage (self):
+        '''Holds back redrawing until the matching release_damage, which \
+           then redraws everything asked for in one go'''
+        self.damage_holds += 1
+
+    def release_damage (self):
+        self.damage_holds -= 1
+        if self.damage_holds or not self.held_damage:
+            return
+        areas = self.held_damage
+        self.held_damage = []
+        if None in areas:
+            self.invalidate ()
+        else:
+            self.damage (*areas)
+
+    def begin_transaction (self):
+        '''Starts a batch of edits.  Until the matching commit_transaction \
+           redrawing, finding the ends of moved links, changes to the \
+           document and undo actions are put off.  Transactions nest, the \
+           outermost commit does it all: one redraw, one pass over the \
+           links, and one undo action for the lot'''
+        self.transactions += 1
+        self.hold_damage ()
+        self.undo.begin_group ()
+
+    def commit_transaction (self):
+        # The counts go down first, so an error below can't leave the
+        # transaction open
+        actions = self.undo.end_group ()
+        self.transactions -= 1
+        try:
+            if not self.transactions:
+                self.flush_elements ()
+                thoughts = self.pending_links
+                self.pending_links = set ()
+                links = set ()
+                for t in thoughts:
+                    links.update (self.links_of (t))
+                for l in links:
+                    l.find_ends ()
+                    self.damage (*self.reindex_link (l))
+            if len (actions) == 1:
+                self.undo.add_undo (actions[0])
+            elif actions:
+                self.undo.add_undo (UndoManager.UndoAction (self, UNDO_TRANSACTION, self.undo_transaction,
+                                                            *actions))
+        finally:
+            self.release_damage ()
+
+    def undo_transaction (self, action, mode):
+        self.begin_transaction ()
+        try:
+            UndoManager.undo_group (action, mode)
+        finally:
+            self.commit_transaction ()
+
+    def add_element (self, element):
+        '''Puts the save element of a thought or link in the document'''
+        if self.transactions:
+            self.defer_element (element, True)
+        elif element.parentNode is not self.element:
+            self.element.appendChild (element)
+
+    def remove_element (self, element):
+        if self.transactions:
+            self.defer_element (element, False)
+        elif element.parentNode is self.element:
+            self.element.removeChild (element)
+
+    def defer_element (self, element, present):
+        if element not in self.pending_elements:
+            self.pending_order.append (element)
+        self.pending_elements[element] = present
+
+    def flush_elements (self):
+        # Only what changed in the end is done, so an element removed
+        # and added back stays where it was
+        for element in self.pending_order:
+            if self.pending_elements[element]:
+                if element.parentNode is not self.element:
+                    self.element.appendChild (element)
+            elif element.parentNode is self.element:
+                self.element.removeChild (element)
+        self.pending_elements = {}
+        self.pending_order = []
 
     def invalidate (self, transformed_area = None):
-        '''Helper function to invalidate the entire screen, forcing a redraw'''
-        rect = None
-        if not transformed_area:
+        '''Helper function to invalidate the screen, forcing a redraw.  \
+           Without an area the entire screen is redrawn, otherwise only the \
+           given map area (x0, y0, x1, y1)'''
+        if self.damage_holds:
+            if transformed_area:
+                transformed_area = (min(transformed_area[0], transformed_area[2]),
+                                    min(transformed_area[1], transformed_area[3]),
+                                    max(transformed_area[0], transformed_area[2]),
+                                    max(transformed_area[1], transformed_area[3]))
+            self.held_damage.append (transformed_area or None)
+            return
+        rect = Gdk.Rectangle()
+        if transformed_area and hasattr(self, "untransform"):
+            ul = self.untransform_coords(min(transformed_area[0], transformed_area[2]),
+                                         min(transformed_area[1], transformed_area[3]))
+            lr = self.untransform_coords(max(transformed_area[0], transformed_area[2]),
+                                         max(transformed_area[1], transformed_area[3]))
+            rect.x = int(math.floor(ul[0])) - DAMAGE_MARGIN
+            rect.y = int(math.floor(ul[1])) - DAMAGE_MARGIN
+            rect.width = int(math.ceil(lr[0])) - rect.x + DAMAGE_MARGIN
+            rect.height = int(math.ceil(lr[1])) - rect.y + DAMAGE_MARGIN
+        else:
             alloc = self.get_allocation ()
-            rect = Gdk.Rectangle()
             rect.x = 0
             rect.y = 0
             rect.width = alloc.width
             rect.height = alloc.height
-        else:
-            ul = self.untransform_coords(transformed_area[0], transformed_area[1])
-            lr = self.untransform_coords(transformed_area[2], transformed_area[3])
-            rect = Gdk.Rectangle (int(ul[0]), int(ul[1]), int(lr[0]-ul[0]), int(lr[1]-ul[1]))
         if self.window:
             self.window.invalidate_rect (rect, True)
 
@@ -716,22 +1007,30 @@ class MMapArea (Gtk.DrawingArea):
         context.translate(-alloc.width/2., -alloc.height/2.)
         context.translate(self.translation[0], self.translation[1])
 
-        for l in self.links:
-            l.draw (context)
-
         self.untransform = context.get_matrix()
         self.transform = context.get_matrix()
         self.transform.invert()
 
-        ax, ay = self.transform_coords(area.x, area.y)
-        width  = area.width / self.scale_fac
-        height = area.height / self.scale_fac
-        for t in self.thoughts:
-            try:
-                if t.lr[0] >= ax and t.ul[0] <= ax + width and t.lr[1] >= ay and t.ul[1] <= ay + height:
-                    t.draw (context)
-            except:
-                t.draw(context)
+        # Pictures of the thoughts in the window are kept decoded
+        vx0, vy0 = context.device_to_user (0, 0)
+        vx1, vy1 = context.device_to_user (alloc.width, alloc.height)
+        pictures.set_in_view (self.thought_index.query_rect (min (vx0, vx1), min (vy0, vy1),
+                                                              max (vx0, vx1), max (vy0, vy1)))
+
+        # Only what lies inside the damaged area needs drawing
+        x0, y0, x1, y1 = context.clip_extents()
+        TextThought.layouts.reset()
+
+        for l in self.link_index.query_rect(x0, y0, x1, y1):
+            l.draw (context)
+
+        for t in self.thought_index.query_rect(x0, y0, x1, y1):
+            self.render_cache.draw (context, t)
+            # Text thoughts work out their size while drawing.  If it
+            # changed, whatever fell outside the clip needs another pass
+            old, new = self.reindex_thought (t)
+            if old != new:
+                self.damage (old, new)
 
         if self.is_bbox_selecting:
             xs = self.bbox_origin[0]
@@ -761,6 +1060,8 @@ class MMapArea (Gtk.DrawingArea):
             #context.set_line_width(2.0)
             #context.set_source_rgba(0.0, 0.0, 0.0, 1.0)
 
+        if utils.debugging:
+            utils.print_debug (self.render_cache.stats (), TextThought.layouts.stats ())
         return False
 
     def undo_create_cb (self, action, mode):
@@ -774,16 +1075,16 @@ class MMapArea (Gtk.DrawingArea):
         else:
             self.emit ("change_mode", action.args[2])
             thought = action.args[0]
-            self.thoughts.append (thought)
+            self.attach_thought (thought)
             for t in action.args[1]:
                 self.unselect_all ()
                 self.select_thought (t, -1)
             self.hookup_im_context (thought)
             self.emit ("change_buffer", thought.extended_buffer)
-            self.element.appendChild (thought.element)
+            self.add_element (thought.element)
             for l in action.args[5:]:
-                self.links.append (l)
-                self.element.appendChild (l.element)
+                self.attach_link (l)
+                self.add_element (l.element)
 
         self.emit ("set_focus", None, False)
         self.undo.unblock ()
@@ -814,7 +1115,7 @@ class MMapArea (Gtk.DrawingArea):
             self.emit ("change_mode", self.old_mode)
         self.nthoughts += 1
         element = thought.element
-        self.element.appendChild (thought.element)
+        self.add_element (thought.element)
         thought.connect ("select_thought", self.select_thought)
         thought.connect ("create_link", self.create_link)
         thought.connect ("update_view", self.update_view)
@@ -823,7 +1124,7 @@ class MMapArea (Gtk.DrawingArea):
         thought.connect ("update_links", self.update_links_cb)
         thought.connect ("grab_focus", self.regain_focus_cb)
         thought.connect ("update-attrs", self.update_attr_cb)
-        self.thoughts.append (thought)
+        self.attach_thought (thought)
         return thought
 
     def regain_focus_cb (self, thought, ext):
@@ -835,15 +1136,15 @@ class MMapArea (Gtk.DrawingArea):
     def delete_thought (self, thought, undo = True):
         if undo:
             action = UndoManager.UndoAction (self, UNDO_DELETE_SINGLE, self.undo_deletion, [thought])
+            action.retain (thought)
         else:
             action = None
 
         if hasattr(thought, 'textview'):
             thought.remove_textview()
 
-        if thought.element in self.element.childNodes:
-            self.element.removeChild (thought.element)
-        self.thoughts.remove (thought)
+        self.remove_element (thought.element)
+        self.detach_thought (thought)
         try:
             self.selected.remove (thought)
         except:
@@ -857,12 +1158,9 @@ class MMapArea (Gtk.DrawingArea):
             self.primary = None
             if self.thoughts:
                 self.make_primary (self.thoughts[0])
-        rem_links = []
-        for l in self.links:
-            if l.uses (thought):
-                if action: action.add_arg (l)
-                rem_links.append (l)
+        rem_links = self.links_of (thought)
         for l in rem_links:
+            if action: action.add_arg (l)
             self.delete_link (l)
 
         for i, obj in enumerate(self.current_root):
@@ -880,12 +1178,12 @@ class MMapArea (Gtk.DrawingArea):
         if mode == UndoManager.UNDO:
             self.unselect_all ()
             for l in action.args[1:]:
-                self.links.append (l)
-                self.element.appendChild (l.element)
+                self.attach_link (l)
+                self.add_element (l.element)
             for t in action.args[0]:
-                self.thoughts.append (t)
+                self.attach_thought (t)
                 self.select_thought (t, -1)
-                self.element.appendChild (t.element)
+                self.add_element (t.element)
                 if t.am_primary and not self.primary:
                     self.emit ("change_buffer", action.args[0][0].extended_buffer)
                     self.make_primary(t)
@@ -902,37 +1200,40 @@ class MMapArea (Gtk.DrawingArea):
         if len(self.selected) == 0:
             return
         action = UndoManager.UndoAction (self, UNDO_DELETE, self.undo_deletion, copy.copy(self.selected))
+        action.retain (*self.selected)
 
+        self.begin_transaction ()
         try:
-            # delete_thought as a callback adds it's own undo action.  Block that here
-            self.undo.block ()
-
-            tmp = self.selected
-            t = tmp.pop()
-            while t:
-                if t in self.thoughts:
-                    for l in self.links:
-                        if l.uses (t):
+            try:
+                # delete_thought as a callback adds it's own undo action.  Block that here
+                self.undo.block ()
+
+                tmp = self.selected
+                t = tmp.pop()
+                while t:
+                    if t in self.thought_index:
+                        for l in self.links_of (t):
                             action.add_arg (l)
-                    self.delete_thought (t)
-                if t in self.links:
-                    self.delete_link (t)
-                if len (tmp) == 0:
-                    t = None
-                else:
-                    t = tmp.pop()
-        finally:
-            self.undo.unblock ()
+                        self.delete_thought (t)
+                    if t in self.link_index:
+                        self.delete_link (t)
+                    if len (tmp) == 0:
+                        t = None
+                    else:
+                        t = tmp.pop()
+            finally:
+                self.undo.unblock ()
 
-        self.undo.add_undo (action)
-        self.invalidate ()
+            self.undo.add_undo (action)
+            self.invalidate ()
+        finally:
+            self.commit_transaction ()
 
     def delete_link (self, link):
-        if link.element in self.element.childNodes:
-            self.element.removeChild (link.element)
+        self.remove_element (link.element)
         #link.element.unlink ()
         try:
-            self.links.remove (link)
+            self.detach_link (link)
         except:
             pass
 
@@ -973,7 +1274,7 @@ class MMapArea (Gtk.DrawingArea):
         if len(self.selected) != 1:
             return None
         initial = self.selected[0]
-        for x in self.links:
+        for x in self.links_of (initial):
             if x.parent == initial:
                 other = x.child
             elif x.child == initial:
@@ -998,56 +1299,72 @@ class MMapArea (Gtk.DrawingArea):
 
     def undo_align(self, action, mode):
         self.undo.block ()
-        dic = action.args[0]
-        if mode == UndoManager.UNDO:
-            for t in dic:
-                t.move_by(-dic[t][0], -dic[t][1])
-        else:
-            for t in dic:
-                t.move_by(dic[t][0], dic[t][1])
-        self.undo.unblock ()
+        self.begin_transaction ()
+        try:
+            dic = action.args[0]
+            if mode == UndoManager.UNDO:
+                for t in dic:
+                    t.move_by(-dic[t][0], -dic[t][1])
+            else:
+                for t in dic:
+                    t.move_by(dic[t][0], dic[t][1])
+        finally:
+            self.commit_transaction ()
+            self.undo.unblock ()
 
     def align_top_left(self, vertical=True):
         dic = {}
-        if len(self.selected) != 0:
-            x = self.selected[0].ul[0]
-            y = self.selected[0].ul[1]
-            for t in self.selected:
-                if vertical:
-                    vec = (-(t.ul[0]-x), 0)
-                else:
-                    vec = (0, -(t.ul[1]-y))
-                t.move_by(vec[0], vec[1])
-                dic[t] = vec
-        self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ALIGN, self.undo_align, dic))
+        self.begin_transaction ()
+        try:
+            if len(self.selected) != 0:
+                x = self.selected[0].ul[0]
+                y = self.selected[0].ul[1]
+                for t in self.selected:
+                    if vertical:
+                        vec = (-(t.ul[0]-x), 0)
+                    else:
+                        vec = (0, -(t.ul[1]-y))
+                    t.move_by(vec[0], vec[1])
+                    dic[t] = vec
+            self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ALIGN, self.undo_align, dic))
+        finally:
+            self.commit_transaction ()
 
     def align_bottom_right(self, vertical=True):
         dic = {}
-        if len(self.selected) != 0:
-            x = self.selected[0].lr[0]
-            y = self.selected[0].lr[1]
-            for t in self.selected:
-                if vertical:
-                    vec = (-(t.lr[0]-x), 0)
-                else:
-                    vec = (0, -(t.lr[1]-y))
-                t.move_by(vec[0], vec[1])
-                dic[t] = vec
-        self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ALIGN, self.undo_align, dic))
+        self.begin_transaction ()
+        try:
+            if len(self.selected) != 0:
+                x = self.selected[0].lr[0]
+                y = self.selected[0].lr[1]
+                for t in self.selected:
+                    if vertical:
+                        vec = (-(t.lr[0]-x), 0)
+                    else:
+                        vec = (0, -(t.lr[1]-y))
+                    t.move_by(vec[0], vec[1])
+                    dic[t] = vec
+            self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ALIGN, self.undo_align, dic))
+        finally:
+            self.commit_transaction ()
 
     def align_centered(self, vertical=True):
         dic = {}
-        if len(self.selected) != 0:
-            x = self.selected[0].ul[0] + (self.selected[0].lr[0] - self.selected[0].ul[0]) / 2.0
-            y = self.selected[0].ul[1] + (self.selected[0].lr[1] - self.selected[0].ul[1]) / 2.0
-            for t in self.selected:
-                if vertical:
-                    vec = (-((t.ul[0] + (t.lr[0]-t.ul[0])/2.0)-x), 0)
-                else:
-                    vec = (0, -((t.ul[1] + (t.lr[1]-t.ul[1])/2.0)-y))
-                t.move_by(vec[0], vec[1])
-                dic[t] = vec
-        self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ALIGN, self.undo_align, dic))
+        self.begin_transaction ()
+        try:
+            if len(self.selected) != 0:
+                x = self.selected[0].ul[0] + (self.selected[0].lr[0] - self.selected[0].ul[0]) / 2.0
+                y = self.selected[0].ul[1] + (self.selected[0].lr[1] - self.selected[0].ul[1]) / 2.0
+                for t in self.selected:
+                    if vertical:
+                        vec = (-((t.ul[0] + (t.lr[0]-t.ul[0])/2.0)-x), 0)
+                    else:
+                        vec = (0, -((t.ul[1] + (t.lr[1]-t.ul[1])/2.0)-y))
+                    t.move_by(vec[0], vec[1])
+                    dic[t] = vec
+            self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ALIGN, self.undo_align, dic))
+        finally:
+            self.commit_transaction ()
 
     def global_key_handler (self, event):
         ## FIXME
@@ -1091,32 +1408,49 @@ class MMapArea (Gtk.DrawingArea):
     def load_thought (self, node, type, tar):
         thought = self.create_new_thought (None, type, loading = True)
         thought.creating = False
+        # Loading replaces the identity the thought was created with
+        if self.thoughts_by_id.get (thought.identity) is thought:
+            del self.thoughts_by_id[thought.identity]
         thought.load (node, tar)
+        self.thoughts_by_id.setdefault (thought.identity, thought)
+        self.reindex_thought (thought)
 
     def load_link (self, node):
         link = Link (self.save)
         self.connect_link (link)
         link.load (node)
-        self.links.append (link)
+        self.attach_link (link)
         element = link.get_save_element ()
-        self.element.appendChild (element)
+        self.add_element (element)
+
+    def load_node (self, node, tar):
+        if node.nodeName == "thought":
+            self.load_thought (node, MODE_TEXT, tar)
+        elif node.nodeName == "label_thought":
+            self.load_thought (node, MODE_LABEL, tar)
+        elif node.nodeName == "image_thought":
+            self.load_thought (node, MODE_IMAGE, tar)
+        elif node.nodeName == "drawing_thought":
+            self.load_thought (node, MODE_DRAW, tar)
+        elif node.nodeName == "res_thought":
+            self.load_thought (node, MODE_RESOURCE, tar)
+        elif node.nodeName == "link":
+            self.load_link (node)
+        else:
+            print "Warning: Unknown element type.  Ignoring: "+node.nodeName
 
     def load_thyself (self, top_element, doc, tar):
         for node in top_element.childNodes:
-            if node.nodeName == "thought":
-                self.load_thought (node, MODE_TEXT, tar)
-            elif node.nodeName == "label_thought":
-                self.load_thought (node, MODE_LABEL, tar)
-            elif node.nodeName == "image_thought":
-                self.load_thought (node, MODE_IMAGE, tar)
-            elif node.nodeName == "drawing_thought":
-                self.load_thought (node, MODE_DRAW, tar)
-            elif node.nodeName == "res_thought":
-                self.load_thought (node, MODE_RESOURCE, tar)
-            elif node.nodeName == "link":
-                self.load_link (node)
-            else:
-                print "Warning: Unknown element type.  Ignoring: "+node.nodeName
+            self.load_node (node, tar)
+
+        self.finish_loading ()
+
+    def load_stream (self, nodes, tar):
+        '''Like load_thyself, but takes the nodes one at a time from an \
+           iterator (see StreamLoader.parse), so the whole document never \
+           needs to be in memory'''
+        for node in nodes:
+            self.load_node (node, tar)
 
         self.finish_loading ()
 
@@ -1130,8 +1464,6 @@ class MMapArea (Gtk.DrawingArea):
             if t.am_selected:
                 self.selected.append (t)
                 t.select ()
-            if t.identity >= self.nthoughts:
-                self.nthoughts = t.identity + 1
         if self.selected:
             self.current_root = self.selected
         else:
@@ -1143,25 +1475,11 @@ class MMapArea (Gtk.DrawingArea):
                    self.selected[0].foreground_color)
         else:
             self.emit ("change_buffer", None)
-        del_links = []
-        for l in self.links:
-            if (l.parent_number == -1 and l.child_number == -1) or \
-               (l.parent_number == l.child_number):
-                del_links.append (l)
-                continue
-            parent = child = None
-            for t in self.thoughts:
-                if t.identity == l.parent_number:
-                    parent = t
-                elif t.identity == l.child_number:
-                    child = t
-                if parent and child:
-                    break
-            l.set_parent_child (parent, child)
-            if not l.parent or not l.child:
-                del_links.append (l)
-        for l in del_links:
-            self.delete_link (l)
+        self.resolve_links ()
+
+    def link_resolved (self, link):
+        self.index_link_ends (link)
+        self.reindex_link (link)
 
     def update_save(self):
         for t in self.thoughts:
@@ -1173,6 +1491,33 @@ class MMapArea (Gtk.DrawingArea):
         for t in self.thoughts:
             t.save(tar)
 
+    def serialize_object (self, obj):
+        '''Returns the saved XML of a thought or link as a utf-8 string. \
+           It is only rebuilt if the object changed since the last save'''
+        key = obj.save_key ()
+        if obj.xml_cache is None or obj.xml_cache[0] != key:
+            obj.update_save ()
+            obj.xml_cache = (key, obj.element.toxml ().encode ("utf-8"))
+        return obj.xml_cache[1]
+
+    def write_manifest (self, tar, arcname):
+        '''Writes the map to the tarball member arcname.  This produces an \
+           equivalent document to update_save and toxml() on self.save, but the \
+           pieces are written one after the other instead of as one string'''
+        attrs = self.element.attributes
+        header = '<?xml version="1.0" ?><MMap'
+        for name in sorted (attrs.keys ()):
+            header += ' %s=%s' % (name, saxutils.quoteattr (attrs[name].value))
+        header += '>'
+
+        chunks = [header.encode ("utf-8")]
+        for t in self.thoughts:
+            chunks.append (self.serialize_object (t))
+        for l in self.links:
+            chunks.append (self.serialize_object (l))
+        chunks.append ('</MMap>')
+        tar.write_chunks (arcname, chunks)
+
     def text_selection_cb (self, thought, start, end, text):
         self.emit ("text_selection_changed", start, end, text)
 
@@ -1191,47 +1536,6 @@ class MMapArea (Gtk.DrawingArea):
             return
         self.selected[0].paste_text (clip)
 
-    def export (self, context, width, height, native):
-        context.rectangle (0, 0, width, height)
-        context.clip ()
-        context.set_source_rgb (1.0,1.0,1.0)
-        context.move_to (0,0)
-        context.paint ()
-        context.set_source_rgb (0.0,0.0,0.0)
-        if not native:
-            move_x = self.move_x
-            move_y = self.move_y
-        else:
-            move_x = 0
-            move_y = 0
-        for l in self.links:
-            l.export (context, move_x, move_y)
-        for t in self.thoughts:
-            t.export (context, move_x, move_y)
-
-    def get_max_area (self):
-        minx = 999
-        maxx = -999
-        miny = 999
-        maxy = -999
-
-        for t in self.thoughts:
-            mx,my,mmx,mmy = t.get_max_area ()
-            if mx < minx:
-                minx = mx
-            if my < miny:
-                miny = my
-            if mmx > maxx:
-                maxx = mmx
-            if mmy > maxy:
-                maxy = mmy
-        # Add a 10px border around all
-        self.move_x = 10-minx
-        self.move_y = 10-miny
-        maxx = maxx-minx+20
-        maxy = maxy-miny+20
-        return (maxx,maxy)
-
     def get_selection_bounds (self):
         if len (self.selected) == 1:
             try:
@@ -1244,10 +1548,7 @@ class MMapArea (Gtk.DrawingArea):
     def thoughts_are_linked (self):
         if len (self.selected) != 2:
             return False
-        for l in self.links:
-            if l.connects (self.selected[0], self.selected[1]):
-                return True
-        return False
+        return self.find_link (self.selected[0], self.selected[1]) is not None
 
     def drag_menu_cb(self, sw, mode):
         if len(self.selected) == 1:
@@ -1309,11 +1610,7 @@ class MMapArea (Gtk.DrawingArea):
         if not self.selected[0].can_be_parent() or \
             not self.selected[1].can_be_parent():
                 return
-        lnk = None
-        for l in self.links:
-            if l.connects (self.selected[0], self.selected[1]):
-                lnk = l
-                break
+        lnk = self.find_link (self.selected[0], self.selected[1])
         if lnk:
             self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DELETE_LINK, self.undo_link_action, lnk))
             self.delete_link (lnk)
@@ -1326,48 +1623,72 @@ class MMapArea (Gtk.DrawingArea):
         if len(self.selected) != 1:
             return
         self.selected[0].set_bold (active)
-        self.invalidate()
+        self.update_view (self.selected[0])
 
     def set_italics (self, active):
         if len(self.selected) != 1:
             return
         self.selected[0].set_italics (active)
-        self.invalidate()
+        self.update_view (self.selected[0])
 
     def set_underline (self, active):
         if len(self.selected) != 1:
             return
         self.selected[0].set_underline (active)
-        self.invalidate()
+        self.update_view (self.selected[0])
 
     def set_background_color(self, color):
-        for s in self.selected:
-            s.background_color = color
-            self.background_color = color
-        if len(self.selected) > 1:
-            self.invalidate()
+        self.begin_transaction ()
+        try:
+            for s in self.selected:
+                s.background_color = color
+                self.background_color = color
+                s.mark_dirty ()
+                self.damage_object (s)
+        finally:
+            self.commit_transaction ()
 
     def set_foreground_color(self, color):
-        for s in self.selected:
-            s.foreground_color = color
-            self.foreground_color = color
-        if len(self.selected) > 1:
-            self.invalidate()
+        self.begin_transaction ()
+        try:
+            for s in self.selected:
+                s.foreground_color = color
+                self.foreground_color = color
+                s.mark_dirty ()
+                self.damage_object (s)
+        finally:
+            self.commit_transaction ()
 
     def set_font(self, font_name, font_size):
         if len (self.selected) == 1 and hasattr(self.selected[0], "set_font"):
             self.selected[0].set_font(font_name, font_size)
             self.font_name = font_name
             self.font_size = font_size
-            self.invalidate()
+            self.update_view (self.selected[0])
 
     def embody_thought(self, event):
         coords = self.transform_coords (event.get_coords()[0], event.get_coords()[1])
+        # The thought, its links and their undo action go in together
+        self.begin_transaction ()
+        try:
+            thought = self.create_linked_thought (event, coords)
+        finally:
+            self.commit_transaction ()
+        if not thought:
+            return True
+
+        thought.enter()
+        thought.includes(coords)
+        event.button = 1
+        thought.process_button_down(event, coords)
+        self.focus = thought
+
+    def create_linked_thought (self, event, coords):
         thought = self.create_new_thought(coords)
         sel = self.selected
 
         if not thought:
-            return True
+            return None
         if not self.primary and \
             thought.can_be_parent():
                 self.make_primary (thought)
@@ -1393,9 +1714,8 @@ class MMapArea (Gtk.DrawingArea):
         thought.background_color = self.background_color
         act = UndoManager.UndoAction (self, UNDO_CREATE, self.undo_create_cb, thought, sel, \
                                       self.mode, self.old_mode, event.get_coords())
-        for l in self.links:
-            if l.uses (thought):
-                act.add_arg (l)
+        for l in self.links_of (thought):
+            act.add_arg (l)
         """
         if self.undo.peak ().undo_type == UNDO_DELETE_SINGLE:
             last_action = self.undo.pop ()
@@ -1405,12 +1725,7 @@ class MMapArea (Gtk.DrawingArea):
         else:
         """
         self.undo.add_undo (act)
-
-        thought.enter()
-        thought.includes(coords)
-        event.button = 1
-        thought.process_button_down(event, coords)
-        self.focus = thought
+        return thought
 
 class CursorFactory:
     __shared_state = {"cursors": {}}
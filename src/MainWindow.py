@@ -33,6 +33,7 @@ import xml.dom.minidom as dom
 import PeriodicSaveThread
 import ImageThought
 import BaseThought
+import TileExport
 
 if os.name != 'nt':
     from gi.repository import GConf
@@ -726,7 +727,7 @@ class LabyrinthWindow (GObject.GObject):
         native = not rad.get_active ()
         dialog.destroy ()
 
-        if mime in ['png', 'jpg']:
+        if mime in ['png', 'jpeg']:
             self.save_as_pixmap(filename, mime, true_width, true_height, bitdepth, native)
         else:
             surface = None
@@ -737,16 +738,13 @@ class LabyrinthWindow (GObject.GObject):
             self.save_surface(surface, true_width, true_height, native)
 
     def save_as_pixmap(self, filename, mime, width, height, bitdepth, native):
-        ## FIXME
-        #pixmap = Gdk.Pixmap (None, width, height, bitdepth)
-        #self.MainArea.export (pixmap.cairo_create (), width, height, native)
-
-        #pb = gtk.gdk.Pixbuf.get_from_drawable(gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8, width, height), \
-        #                                      pixmap, \
-        #                                      gtk.gdk.colormap_get_system(), \
-        #                                      0, 0, 0, 0, width, height)
-        #pb.save(filename, mime)
-        
+        # Rendered in tiles, so big maps don't need a surface of their size
+        if mime == 'png':
+            TileExport.export_png (self.MainArea, filename, width, height, native)
+        else:
+            pb = TileExport.export_pixbuf (self.MainArea, width, height, native)
+            pb.savev (filename, mime, [], [])
+
     def save_surface(self, surface, width, height, native):
         cairo_context = cairo.Context(surface)
         context = pangocairo.CairoContext(cairo_context)
@@ -0,0 +1,129 @@
+# MapDocument.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Loads a saved map into thoughts and links without any widget, so it
+# can be exported where there is no window, or no display at all.
+
+import tarfile
+import zipfile
+import xml.dom.minidom as dom
+
+from gi.repository import Gdk
+from gi.repository import PangoCairo
+
+import TextThought
+import LabelThought
+import ImageThought
+import DrawingThought
+import ResourceThought
+import UndoManager
+import SpatialIndex
+import StreamLoader
+from Links import Link
+from MapModel import MapModel
+from port.tarball import Tarball
+
+# Element name -> thought class, as MMapArea.load_node reads them
+THOUGHT_TYPES = {"thought": TextThought.TextThought,
+                 "label_thought": LabelThought.LabelThought,
+                 "image_thought": ImageThought.ImageThought,
+                 "drawing_thought": DrawingThought.DrawingThought,
+                 "res_thought": ResourceThought.ResourceThought}
+
+class MapDocument (MapModel):
+    ''' The thoughts and links of a map, read from a saved file, with \
+        the spatial indexes MMapArea keeps.  Loading and exporting go \
+        through the same MapModel code as MMapArea, so everything that \
+        exports an area (TileExport, ExportEngine) draws it just the \
+        same.  Nothing here can be edited or drawn on screen'''
+
+    def __init__(self):
+        self.thoughts = []
+        self.links = []
+        self.thoughts_by_id = {}
+        self.thought_index = SpatialIndex.SpatialIndex()
+        self.link_index = SpatialIndex.SpatialIndex()
+        self.title = ""
+        self.move_x = 0
+        self.move_y = 0
+        self.nthoughts = 0
+
+        # A font map of its own, no screen is needed to measure text
+        self.pango_context = PangoCairo.FontMap.get_default ().create_context ()
+        self.undo = UndoManager.UndoManager (self)
+        impl = dom.getDOMImplementation()
+        self.save = impl.createDocument("http://www.donscorgie.blueyonder.co.uk/labns", "MMap", None)
+        self.element = self.save.documentElement
+        self.background_color = Gdk.Color (65535, 65535, 65535)
+        self.foreground_color = Gdk.Color (0, 0, 0)
+
+    def load (self, filename):
+        ''' Reads the map saved in filename, either an archive as the \
+            activity writes or a bare MANIFEST.  Pictures can only be \
+            found in an archive '''
+        if tarfile.is_tarfile (filename) or zipfile.is_zipfile (filename):
+            tar = Tarball (filename)
+            try:
+                self.load_stream (tar.open (tar.getnames ()[0]), tar)
+            finally:
+                tar.close ()
+        else:
+            f = open (filename, 'rb')
+            try:
+                self.load_stream (f, None)
+            finally:
+                f.close ()
+
+    def load_stream (self, fileobj, tar):
+        nodes = StreamLoader.parse (fileobj)
+        top_element = nodes.next ()
+        self.title = top_element.getAttribute ("title")
+        for node in nodes:
+            self.load_node (node, tar)
+        self.finish_loading ()
+
+    def load_node (self, node, tar):
+        if node.nodeName == "link":
+            link = Link (self.save)
+            link.load (node)
+            self.links.append (link)
+        elif node.nodeName in THOUGHT_TYPES:
+            thought = THOUGHT_TYPES[node.nodeName] (None, self.pango_context, self.nthoughts, self.save, self.undo,
+                                                    True, self.background_color, self.foreground_color)
+            thought.creating = False
+            thought.load (node, tar)
+            self.nthoughts = max (self.nthoughts, thought.identity) + 1
+            self.attach_thought (thought)
+        else:
+            print "Warning: Unknown element type.  Ignoring: "+node.nodeName
+
+    def finish_loading (self):
+        self.resolve_links ()
+
+    def link_resolved (self, link):
+        self.link_index.insert (link, self.link_bounds (link))
+
+    def delete_link (self, link):
+        self.links.remove (link)
+
+def load (filename):
+    ''' Returns the MapDocument saved in filename '''
+    document = MapDocument ()
+    document.load (filename)
+    return document
@@ -0,0 +1,120 @@
+# MapModel.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# What MMapArea and MapDocument have in common: thoughts and links kept
+# in spatial indexes, resolving links after loading, and exporting.
+
+class MapModel (object):
+    ''' Mixed into the classes holding a map.  They provide thoughts, \
+        links, thoughts_by_id, thought_index, link_index, nthoughts, \
+        move_x and move_y, and the hooks link_resolved (link), called \
+        for each link found to join two thoughts when loading, and \
+        delete_link (link)'''
+
+    def thought_bounds (self, thought):
+        '''Returns the area a thought may draw into or respond to clicks in, \
+           or None if it has no extents yet'''
+        mx, my, mmx, mmy = thought.get_max_area ()
+        if mx > mmx or my > mmy:
+            return None
+        pad = thought.sensitive
+        return (mx - pad, my - pad, mmx + pad, mmy + pad)
+
+    def link_bounds (self, link):
+        if not link.start or not link.end:
+            return None
+        pad = 3 + link.strength
+        return (min(link.start[0], link.end[0]) - pad, min(link.start[1], link.end[1]) - pad,
+                max(link.start[0], link.end[0]) + pad, max(link.start[1], link.end[1]) + pad)
+
+    def attach_thought (self, thought):
+        self.thoughts.append (thought)
+        self.thought_index.insert (thought, self.thought_bounds (thought))
+        self.thoughts_by_id.setdefault (thought.identity, thought)
+
+    def resolve_links (self):
+        ''' Called once every thought and link is loaded.  Connects the \
+            links to the thoughts they name, deleting those that don't \
+            join two thoughts, and gives thoughts sharing an identity \
+            ones of their own '''
+        for t in self.thoughts:
+            if t.identity >= self.nthoughts:
+                self.nthoughts = t.identity + 1
+        del_links = []
+        for l in self.links:
+            if (l.parent_number == -1 and l.child_number == -1) or \
+               (l.parent_number == l.child_number):
+                del_links.append (l)
+                continue
+            parent = self.thoughts_by_id.get (l.parent_number)
+            child = self.thoughts_by_id.get (l.child_number)
+            l.set_parent_child (parent, child)
+            if not l.parent or not l.child:
+                del_links.append (l)
+            else:
+                self.link_resolved (l)
+        for l in del_links:
+            self.delete_link (l)
+
+        # Older versions saved every text thought with identity 0.  Now that
+        # the links are resolved, give the duplicates identities of their own
+        for t in self.thoughts:
+            if self.thoughts_by_id.get (t.identity) is not t:
+                t.identity = self.nthoughts
+                self.nthoughts += 1
+                self.thoughts_by_id[t.identity] = t
+
+    def export (self, context, width, height, native):
+        context.rectangle (0, 0, width, height)
+        context.clip ()
+        context.set_source_rgb (1.0,1.0,1.0)
+        context.move_to (0,0)
+        context.paint ()
+        context.set_source_rgb (0.0,0.0,0.0)
+        if not native:
+            move_x = self.move_x
+            move_y = self.move_y
+        else:
+            move_x = 0
+            move_y = 0
+        # When exporting in tiles, only what touches the tile is drawn
+        x0, y0, x1, y1 = context.clip_extents ()
+        x0 -= move_x
+        x1 -= move_x
+        y0 -= move_y
+        y1 -= move_y
+        for l in self.link_index.query_rect (x0, y0, x1, y1):
+            l.export (context, move_x, move_y)
+        for t in self.thought_index.query_rect (x0, y0, x1, y1):
+            t.export (context, move_x, move_y)
+
+    def get_max_area (self):
+        ''' Returns the size of the map with a 10px border, and sets \
+            move_x, move_y to put its top left corner there '''
+        if not self.thoughts:
+            self.move_x = self.move_y = 10
+            return (20, 20)
+        areas = [t.get_max_area () for t in self.thoughts]
+        minx = min ([a[0] for a in areas])
+        miny = min ([a[1] for a in areas])
+        maxx = max ([a[2] for a in areas])
+        maxy = max ([a[3] for a in areas])
+        self.move_x = 10-minx
+        self.move_y = 10-miny
+        return (maxx-minx+20, maxy-miny+20)
@@ -0,0 +1,102 @@
+# PictureCache.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import weakref
+from collections import OrderedDict
+
+import utils
+
+# Memory allowed for decoded pictures, in bytes
+MAX_BYTES = 64 * 1024 * 1024
+
+class PictureCache:
+    ''' Keeps track of the image thoughts holding decoded pixels, in the \
+        order they were last drawn.  Once they use more than max_bytes \
+        together, the pictures drawn longest ago are dropped by calling \
+        drop_picture() on their thoughts, which decode them again when \
+        they next come into view.  Pictures in view (see set_in_view) \
+        and the most recently drawn one are never dropped, the cache \
+        goes over max_bytes if they need it.  Thoughts showing the \
+        same picture share its ImagePyramid, found by the hash of the \
+        picture's data in pyramids for as long as any thought uses it'''
+
+    def __init__(self, max_bytes = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # hash -> ImagePyramid
+        self.pyramids = weakref.WeakValueDictionary()
+        # hash -> [(thought, job), ...] waiting for a picture being decoded
+        self.decoding = {}
+        self.bytes = 0
+        self.dropped = 0
+        # Thoughts in view of the window, as of the last frame drawn
+        self.in_view = set()
+
+    def touch (self, thought, nbytes):
+        ''' Marks the picture of thought as just used, taking nbytes '''
+        self.bytes -= self.entries.pop (thought, 0)
+        # Most recently used entries live at the end
+        self.entries[thought] = nbytes
+        self.bytes += nbytes
+        self.trim ()
+
+    def set_in_view (self, thoughts):
+        ''' Tells which thoughts are in view, called before each frame. \
+            Pictures that went out of view may be dropped now '''
+        self.in_view = set(thoughts)
+        self.trim ()
+
+    def trim (self):
+        if self.bytes <= self.max_bytes or len(self.entries) < 2:
+            return
+        newest = next (reversed (self.entries))
+        # Oldest first, leaving alone what is on screen
+        victims = [t for t in self.entries if t not in self.in_view and t is not newest]
+        for thought in victims:
+            if self.bytes <= self.max_bytes:
+                break
+            self.bytes -= self.entries.pop (thought)
+            self.dropped += 1
+            thought.drop_picture ()
+            if utils.debugging:
+                utils.print_debug (self.stats ())
+
+    def forget (self, thought):
+        ''' Stops tracking thought, which has left the map, and frees its \
+            picture.  If it comes back (on undo), it decodes it again '''
+        held = thought in self.entries
+        self.bytes -= self.entries.pop (thought, 0)
+        self.in_view.discard (thought)
+        for key, waiters in self.decoding.items ():
+            left = [w for w in waiters if w[0] is not thought]
+            if len (left) == len (waiters):
+                continue
+            held = True
+            if left:
+                self.decoding[key] = left
+            else:
+                del self.decoding[key]
+        if held:
+            thought.drop_picture ()
+
+    def stats (self):
+        return "Picture cache: %d pictures in %d bytes, %d dropped" % \
+            (len(self.entries), self.bytes, self.dropped)
+
+pictures = PictureCache ()
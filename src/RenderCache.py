@@ -0,0 +1,121 @@
+# RenderCache.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import math
+import cairo
+from collections import OrderedDict
+
+# Total number of pixels kept in cached surfaces (4 bytes each)
+MAX_PIXELS = 8 * 1024 * 1024
+
+class RenderCache:
+    ''' Keeps a rasterised copy of each thought, so that redrawing the map \
+        (e.g. while panning) only has to copy pixels around.  A thought is \
+        only drawn again when its render_key() or the zoom level changes.  \
+        Thoughts returning None from render_key() are always drawn directly. \
+        The least recently used surfaces are dropped once the cache grows \
+        past max_pixels'''
+
+    def __init__(self, max_pixels = MAX_PIXELS):
+        self.max_pixels = max_pixels
+        self.entries = OrderedDict()
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def draw (self, context, thought):
+        key = thought.render_key ()
+        if key is None:
+            self.uncached += 1
+            thought.draw (context)
+            return
+
+        scale = context.get_matrix().xx
+        entry = self.entries.pop (thought, None)
+        if entry and entry[0] == key and entry[1] == scale:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if entry:
+                self.pixels -= entry[3]
+            entry = self.render (thought, key, scale)
+            if not entry:
+                thought.draw (context)
+                return
+            self.pixels += entry[3]
+
+        # Most recently used entries live at the end
+        self.entries[thought] = entry
+        self.blit (context, thought, entry)
+        self.trim ()
+
+    def render (self, thought, key, scale):
+        pad = thought.sensitive
+        x0 = thought.ul[0] - pad
+        y0 = thought.ul[1] - pad
+        width = int(math.ceil((thought.lr[0] - x0 + pad) * scale))
+        height = int(math.ceil((thought.lr[1] - y0 + pad) * scale))
+        if width <= 0 or height <= 0 or width * height > self.max_pixels / 4:
+            return None
+
+        surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, width, height)
+        context = cairo.Context (surface)
+        context.scale (scale, scale)
+        context.translate (-x0, -y0)
+        thought.draw (context)
+        # Drawing may have changed the thought (text thoughts recalculate
+        # their size), in which case the surface is of no use
+        if thought.render_key () != key:
+            return None
+        return (key, scale, surface, width * height, pad)
+
+    def blit (self, context, thought, entry):
+        pad = entry[4]
+        x, y = context.user_to_device (thought.ul[0] - pad, thought.ul[1] - pad)
+        # Copy pixel for pixel, rather than resampling the surface
+        context.save ()
+        context.identity_matrix ()
+        context.set_source_surface (entry[2], round(x), round(y))
+        context.paint ()
+        context.restore ()
+
+    def trim (self):
+        while self.pixels > self.max_pixels and self.entries:
+            thought, entry = self.entries.popitem (last = False)
+            self.pixels -= entry[3]
+
+    def forget (self, thought):
+        entry = self.entries.pop (thought, None)
+        if entry:
+            self.pixels -= entry[3]
+
+    def clear (self):
+        self.entries.clear ()
+        self.pixels = 0
+
+    def hit_rate (self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return 100.0 * self.hits / total
+
+    def stats (self):
+        return "Render cache: %d hits, %d misses (%.1f%%), %d drawn directly, %d surfaces, %d pixels" % \
+            (self.hits, self.misses, self.hit_rate (), self.uncached, len(self.entries), self.pixels)
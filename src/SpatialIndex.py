@@ -0,0 +1,146 @@
+# SpatialIndex.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import math
+
+# Size (in map units) of one grid cell.  Thoughts are usually around
+# 100x70, so most of them only touch a handful of cells.
+CELL_SIZE = 128.0
+
+class SpatialIndex:
+    ''' A uniform grid over map coordinates.  Every object is stored in \
+        each cell its bounding box touches, so point and rectangle queries \
+        only have to look at the objects near the area asked about.  \
+        Objects without bounds (e.g. thoughts still being created) are \
+        returned by every query.  Results come back in insertion order, \
+        which matches the drawing (z) order of the lists in MMapArea'''
+
+    def __init__(self, cell_size = CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.bounds = {}
+        self.order = {}
+        self.unbounded = set()
+        self.serial = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, obj):
+        return obj in self.order
+
+    def get_bounds(self, obj):
+        return self.bounds.get(obj)
+
+    def cell_range(self, bounds):
+        size = self.cell_size
+        return (int(math.floor(bounds[0] / size)), int(math.floor(bounds[1] / size)),
+                int(math.floor(bounds[2] / size)), int(math.floor(bounds[3] / size)))
+
+    def insert(self, obj, bounds):
+        if obj in self.order:
+            self.update(obj, bounds)
+            return
+        self.serial += 1
+        self.order[obj] = self.serial
+        self.add_cells(obj, bounds)
+
+    def remove(self, obj):
+        if obj not in self.order:
+            return None
+        old = self.bounds.get(obj)
+        self.remove_cells(obj)
+        del self.order[obj]
+        return old
+
+    def update(self, obj, bounds):
+        '''Move obj to new bounds, keeping its place in the order.  \
+           Returns the bounds it had before'''
+        if obj not in self.order:
+            self.insert(obj, bounds)
+            return None
+        old = self.bounds.get(obj)
+        if old == bounds:
+            return old
+        if old is not None and bounds is not None and \
+           self.cell_range(old) == self.cell_range(bounds):
+            self.bounds[obj] = bounds
+            return old
+        self.remove_cells(obj)
+        self.add_cells(obj, bounds)
+        return old
+
+    def add_cells(self, obj, bounds):
+        self.bounds[obj] = bounds
+        if bounds is None:
+            self.unbounded.add(obj)
+            return
+        x0, y0, x1, y1 = self.cell_range(bounds)
+        for cx in xrange(x0, x1 + 1):
+            for cy in xrange(y0, y1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(obj)
+
+    def remove_cells(self, obj):
+        bounds = self.bounds.pop(obj, None)
+        if bounds is None:
+            self.unbounded.discard(obj)
+            return
+        x0, y0, x1, y1 = self.cell_range(bounds)
+        for cx in xrange(x0, x1 + 1):
+            for cy in xrange(y0, y1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    continue
+                cell.discard(obj)
+                if not cell:
+                    del self.cells[(cx, cy)]
+
+    def query_rect(self, x0, y0, x1, y1):
+        '''Returns all objects whose bounds intersect the given rectangle'''
+        if x0 > x1:
+            x0, x1 = x1, x0
+        if y0 > y1:
+            y0, y1 = y1, y0
+        cx0, cy0, cx1, cy1 = self.cell_range((x0, y0, x1, y1))
+        found = set()
+        # When zoomed far out the rectangle may span more cells than are
+        # actually in use, so walk the occupied cells instead
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            for (cx, cy), cell in self.cells.iteritems():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    found.update(cell)
+        else:
+            for cx in xrange(cx0, cx1 + 1):
+                for cy in xrange(cy0, cy1 + 1):
+                    cell = self.cells.get((cx, cy))
+                    if cell:
+                        found.update(cell)
+
+        result = []
+        for obj in found:
+            b = self.bounds[obj]
+            if b[2] >= x0 and b[0] <= x1 and b[3] >= y0 and b[1] <= y1:
+                result.append(obj)
+        result.extend(self.unbounded)
+        result.sort(key=self.order.__getitem__)
+        return result
+
+    def query_point(self, x, y):
+        '''Returns all objects whose bounds contain the point (x, y)'''
+        return self.query_rect(x, y, x, y)
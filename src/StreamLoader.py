@@ -0,0 +1,89 @@
+# StreamLoader.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Reads a map MANIFEST one top level element (thought or link) at a time,
+# instead of building a DOM of the whole document first.  The elements
+# handed out behave like the xml.dom.minidom nodes the load() methods of
+# thoughts and links expect.
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+def local_name (tag):
+    # Drop the namespace part ElementTree puts in front of tag names
+    return tag.rsplit ('}', 1)[-1]
+
+class TextNode (object):
+    ''' Stands in for a minidom Text node '''
+    ELEMENT_NODE = 1
+    TEXT_NODE = 3
+    nodeType = TEXT_NODE
+    nodeName = "#text"
+    childNodes = ()
+
+    def __init__ (self, data):
+        self.data = unicode(data)
+
+class ElementNode (object):
+    ''' Stands in for a minidom Element, wrapping an ElementTree element '''
+    ELEMENT_NODE = 1
+    TEXT_NODE = 3
+    nodeType = ELEMENT_NODE
+
+    def __init__ (self, element):
+        self.nodeName = local_name (element.tag)
+        self.attrs = dict([(local_name (k), v) for k, v in element.attrib.iteritems()])
+        nodes = []
+        if element.text:
+            nodes.append (TextNode (element.text))
+        for child in element:
+            nodes.append (ElementNode (child))
+            if child.tail:
+                nodes.append (TextNode (child.tail))
+        self.childNodes = nodes
+
+    def hasAttribute (self, name):
+        return name in self.attrs
+
+    def getAttribute (self, name):
+        return unicode(self.attrs.get (name, ""))
+
+def parse (fileobj):
+    ''' Generator reading the MANIFEST from fileobj.  It first yields the \
+        top level element (without children), then each of its children \
+        in document order.  A child is dropped from memory once the next \
+        one has been asked for '''
+    depth = 0
+    root = None
+    for event, element in ElementTree.iterparse (fileobj, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                root = element
+                top = ElementNode (element)
+                yield top
+            continue
+
+        depth -= 1
+        if depth == 1:
+            yield ElementNode (element)
+            element.clear ()
+            root.remove (element)
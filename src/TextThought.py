@@ -34,6 +34,7 @@ import xml.dom
 import utils
 import BaseThought
 import UndoManager
+import Utf8Index
 from BaseThought import *
 import prefs
 
@@ -42,6 +43,22 @@ UNDO_ADD_ATTR_SELECTION=65
 UNDO_REMOVE_ATTR=66
 UNDO_REMOVE_ATTR_SELECTION=67
 
+class LayoutCounter:
+    ''' Counts the Pango layouts text thoughts built and reused, from \
+        the start of a frame (see MMapArea.draw) '''
+
+    def __init__(self):
+        self.reset ()
+
+    def reset (self):
+        self.built = 0
+        self.reused = 0
+
+    def stats (self):
+        return "Text layouts: %d built, %d reused" % (self.built, self.reused)
+
+layouts = LayoutCounter ()
+
 class TextThought (ResizableThought):
     def __init__ (self, coords, pango_context, thought_number, save, undo,
               loading, background_color, foreground_color, name="thought",
@@ -50,11 +67,15 @@ class TextThought (ResizableThought):
 
         self.index = 0
         self.end_index = 0
-        self.bytes = ""
+        # Character <-> byte offsets in self.text
+        self.offsets = Utf8Index.Utf8Index ()
         self.bindex = 0
         self.text_element = save.createTextNode ("GOOBAH")
         self.element.appendChild (self.text_element)
         self.layout = None
+        # Set when the layout needs building again, see invalidate_layout
+        self.layout_dirty = True
+        self.layout_size = (0, 0)
         self.identity = thought_number
         self.pango_context = pango_context
         self.moving = False
@@ -101,48 +122,34 @@ class TextThought (ResizableThought):
         self.tag_font = buffer.create_tag("font", font=self.attributes["font"])
 
     def index_from_bindex(self, bindex):
-        if bindex == 0:
-            return 0
-
-        index = 0
-        for x in range(bindex):
-            index += int(self.bytes[x])
-
-        return index
+        return self.offsets.byte_offset (bindex)
 
     def bindex_from_index(self, index):
-        if index == 0:
-            return 0
-
-        bind = 0
-        nbytes = 0
-
-        for x in self.bytes:
-            nbytes += int (x)
-            bind+=1
-            if nbytes == index:
-                break
-
-        if nbytes < index:
-            bind = len(self.bytes)
-
-        return bind
+        return self.offsets.char_offset (index)
 
     def recalc_text_edges (self):
         if (not hasattr(self, "layout")):
             return
 
-        self.layout = Pango.Layout(self.pango_context)
+        # The layout isn't given a width, so resizing the thought only
+        # moves the text and the layout is kept
+        if self.layout is None or self.layout_dirty:
+            self.layout = Pango.Layout(self.pango_context)
 
-        if self.textview != None:
-            start, end = self.textview.get_buffer().get_bounds()
-            text = self.textview.get_buffer().get_text(start, end, True)
-            self.layout.set_text(text, len(text))
+            if self.textview != None:
+                start, end = self.textview.get_buffer().get_bounds()
+                text = self.textview.get_buffer().get_text(start, end, True)
+                self.layout.set_text(text, len(text))
 
-        ##self.layout.set_attributes(self.attrlist)
+            ##self.layout.set_attributes(self.attrlist)
+            self.layout_size = self.layout.get_pixel_size()
+            self.layout_dirty = False
+            layouts.built += 1
+        else:
+            layouts.reused += 1
 
         margin = utils.margin_required(utils.STYLE_NORMAL)
-        text_w, text_h = self.layout.get_pixel_size()
+        text_w, text_h = self.layout_size
         text_w += margin[0] + margin[2]
         text_h += margin[1] + margin[3]
 
@@ -154,6 +161,11 @@ class TextThought (ResizableThought):
         self.max_x = self.min_x + text_w
         self.max_y = self.min_y + text_h
 
+    def invalidate_layout (self, *args):
+        ''' Has the layout built again on the next recalc_edges.  To be \
+            called whenever the text, the font or the attributes change '''
+        self.layout_dirty = True
+
     def recalc_edges (self):
         self.lr = (self.ul[0] + self.width, self.ul[1] + self.height)
         if not self.creating:
@@ -170,32 +182,18 @@ class TextThought (ResizableThought):
 
     def add_text (self, string):
         if self.index > self.end_index:
-            left = self.text[:self.end_index]
-            right = self.text[self.index:]
-            bleft = self.bytes[:self.b_f_i (self.end_index)]
-            bright = self.bytes[self.b_f_i (self.index):]
-            change = self.end_index - self.index + len(string)
-            old = self.index
-            self.index = self.end_index
-            self.end_index = old
-        elif self.index < self.end_index:
-            left = self.text[:self.index]
-            right = self.text[self.end_index:]
-            bleft = self.bytes[:self.b_f_i (self.index)]
-            bright = self.bytes[self.b_f_i (self.end_index):]
-            change = self.index - self.end_index + len(string)
-        else:
-            left = self.text[:self.index]
-            right = self.text[self.index:]
-            bleft = self.bytes[:self.b_f_i(self.index)]
-            bright = self.bytes[self.b_f_i(self.index):]
-            change = len(string)
+            self.index, self.end_index = self.end_index, self.index
+        left = self.text[:self.index]
+        right = self.text[self.end_index:]
+        self.bindex = self.b_f_i (self.index)
+        self.offsets.delete (self.bindex, self.b_f_i (self.end_index))
+        self.offsets.insert (self.bindex, string)
 
         self.text = left + string + right
+        self.invalidate_layout ()
         self.undo.add_undo (UndoManager.UndoAction (self, UndoManager.INSERT_LETTER, self.undo_text_action,
                             self.bindex, string, len(string), self.attributes, []))
         self.index += len (string)
-        self.bytes = bleft + str(len(string)) + bright
         self.bindex = self.b_f_i (self.index)
         self.end_index = self.index
 
@@ -243,6 +241,16 @@ class TextThought (ResizableThought):
         context.set_source_rgb (0,0,0)
         context.stroke ()
 
+    def render_key (self):
+        # The cursor is drawn while editing
+        if self.editing or self.textview is not None:
+            return None
+        key = ResizableThought.render_key (self)
+        if key is None:
+            return None
+        return key + (self.text, utils.gtk_to_cairo_color(self.foreground_color),
+                      tuple(sorted(self.attributes.items())))
+
     def process_key_press (self, event, mode):
         # Since we are using textviews, we don't use the
         # keypress code anymore
@@ -328,8 +336,6 @@ class TextThought (ResizableThought):
         else:
             attrs = attrslist[1]
             self.add_text (action.text)
-            self.rebuild_byte_table ()
-            self.bindex = self.b_f_i (self.index)
 
         self.recalc_edges ()
         self.emit ("title_changed", self.text)
@@ -342,32 +348,33 @@ class TextThought (ResizableThought):
             return
         if self.index > self.end_index:
             self.index, self.end_index = self.end_index, self.index
+        start = self.b_f_i (self.index)
         if self.index != self.end_index:
             left = self.text[:self.index]
             right = self.text[self.end_index:]
             local_text = self.text[self.index:self.end_index]
-            bleft = self.bytes[:self.b_f_i (self.index)]
-            bright = self.bytes[self.b_f_i (self.end_index):]
-            local_bytes = self.bytes[self.b_f_i (self.index):self.b_f_i (self.end_index)]
+            end = self.b_f_i (self.end_index)
             change = -len(local_text)
         else:
+            size = self.offsets.size (start)
             left = self.text[:self.index]
-            right = self.text[self.index+int(self.bytes[self.bindex]):]
-            local_text = self.text[self.index:self.index+int(self.bytes[self.bindex])]
-            bleft = self.bytes[:self.b_f_i(self.index)]
-            bright = self.bytes[self.b_f_i(self.index)+1:]
-            local_bytes = self.bytes[self.b_f_i(self.index)]
+            right = self.text[self.index+size:]
+            local_text = self.text[self.index:self.index+size]
+            end = start + 1
             change = -len(local_text)
+        # The number of characters deleted
+        local_chars = end - start
 
         changes= []
         old_attrs = self.attributes.copy()
         accounted = -change
 
         self.undo.add_undo (UndoManager.UndoAction (self, UndoManager.DELETE_LETTER, self.undo_text_action,
-                            self.b_f_i (self.index), local_text, len(local_text), local_bytes, old_attrs,
+                            start, local_text, len(local_text), local_chars, old_attrs,
                             changes))
         self.text = left+right
-        self.bytes = bleft+bright
+        self.offsets.delete (start, end)
+        self.invalidate_layout ()
         self.end_index = self.index
 
     def backspace_char (self):
@@ -380,32 +387,34 @@ class TextThought (ResizableThought):
         if self.index != self.end_index:
             left = self.text[:self.index]
             right = self.text[self.end_index:]
-            bleft = self.bytes[:self.b_f_i (self.index)]
-            bright = self.bytes[self.b_f_i (self.end_index):]
+            start = self.b_f_i (self.index)
+            end = self.b_f_i (self.end_index)
             local_text = self.text[self.index:self.end_index]
-            local_bytes = self.bytes[self.b_f_i (self.index):self.b_f_i (self.end_index)]
             change = -len(local_text)
 
         else:
-            left = self.text[:self.index-int(self.bytes[self.bindex-1])]
+            end = self.b_f_i (self.index)
+            start = end - 1
+            size = self.offsets.size (start)
+            left = self.text[:self.index-size]
             right = self.text[self.index:]
-            bleft = self.bytes[:self.b_f_i(self.index)-1]
-            bright = self.bytes[self.b_f_i(self.index):]
-            local_text = self.text[self.index-int(self.bytes[self.bindex-1]):self.index]
-            local_bytes = self.bytes[self.b_f_i(self.index)-1]
-            self.index-=int(self.bytes[self.bindex-1])
+            local_text = self.text[self.index-size:self.index]
+            self.index-=size
             change = -len(local_text)
+        # The number of characters deleted
+        local_chars = end - start
 
         old_attrs = self.attributes.copy()
         changes = []
         accounted = -change
 
         self.text = left+right
-        self.bytes = bleft+bright
+        self.offsets.delete (start, end)
+        self.invalidate_layout ()
         self.end_index = self.index
 
         self.undo.add_undo(UndoManager.UndoAction (self, UndoManager.DELETE_LETTER, self.undo_text_action,
-                           self.b_f_i (self.index), local_text, len(local_text), local_bytes, old_attrs,
+                           start, local_text, len(local_text), local_chars, old_attrs,
                            changes))
 
         if self.index < 0:
@@ -416,7 +425,7 @@ class TextThought (ResizableThought):
             self.index = 0
             return
 
-        self.index -= int(self.bytes[self.bindex-1])
+        self.index -= self.offsets.size (self.bindex-1)
 
         if not mod:
             self.end_index = self.index
@@ -425,7 +434,7 @@ class TextThought (ResizableThought):
         if self.index >= len(self.text):
             self.index = len(self.text)
             return
-        self.index += int(self.bytes[self.bindex])
+        self.index += self.offsets.size (self.bindex)
         if not mod:
             self.end_index = self.index
 
@@ -562,6 +571,9 @@ class TextThought (ResizableThought):
         # by grabbing keyboard events.
         if self.textview is None:
             self.textview = Gtk.TextView()
+            # The layout shows what is typed into the textview
+            self.textview.get_buffer().connect('changed', self.invalidate_layout)
+            self.invalidate_layout()
             margin = utils.margin_required (utils.STYLE_NORMAL)
             x, y, w, h = self.textview_rescale()
             self.textview.set_size_request(w if w > 0 else 1, h if h > 0 else 1)
@@ -848,28 +860,13 @@ class TextThought (ResizableThought):
                 break
         """
     def rebuild_byte_table (self):
-        # Build the Byte table
-        del self.bytes
-        self.bytes = ''
-        tmp = self.text.encode ("utf-8")
-        current = 0
-        for z in range(len(self.text)):
-            if str(self.text[z]) == str(tmp[current]):
-                self.bytes += '1'
-            else:
-                blen = 2
-                while 1:
-                    try:
-                        if str(tmp[current:current+blen].encode()) == str(self.text[z]):
-                            self.bytes += str(blen)
-                            current+=(blen-1)
-                            break
-                        blen += 1
-                    except:
-                        blen += 1
-            current+=1
+        # Keep the text as UTF-8 and index its characters, after it was
+        # replaced as a whole
+        if isinstance (self.text, unicode):
+            self.text = self.text.encode ("utf-8")
+        self.offsets = Utf8Index.Utf8Index (self.text)
         self.bindex = self.b_f_i (self.index)
-        self.text = tmp
+        self.invalidate_layout ()
 
     def load (self, node, tar):
         self.index = 0 ##int (node.getAttribute ("cursor"))
@@ -882,7 +879,8 @@ class TextThought (ResizableThought):
         self.width = self.lr[0] - self.ul[0]
         self.height = self.lr[1] - self.ul[1]
 
-        self.identity = 0 ##int (node.getAttribute ("identity"))
+        if node.hasAttribute ("identity"):
+            self.identity = int (node.getAttribute ("identity"))
         try:
             tmp = node.getAttribute ("background-color")
             self.background_color = Gdk.Color.parse(tmp)
@@ -1025,6 +1023,7 @@ class TextThought (ResizableThought):
                 pass##self.attributes = action.args[1].copy()
             elif action.undo_type == UNDO_ADD_ATTR_SELECTION:
                 pass##self.attributes = action.args[1].copy()
+        self.invalidate_layout()
         self.recalc_edges()
         self.emit("update_view")
         self.undo.unblock()
@@ -1108,14 +1107,17 @@ class TextThought (ResizableThought):
 
     def set_bold(self, active):
         self.attributes["bold"] = active
+        self.invalidate_layout()
         self.apply_tags()
 
     def set_italics(self, active):
         self.attributes["italic"] = active
+        self.invalidate_layout()
         self.apply_tags()
 
     def set_underline (self, active):
         self.attributes["underline"] = active
+        self.invalidate_layout()
         self.apply_tags()
 
     def set_font (self, font_name, font_size):
@@ -1127,6 +1129,7 @@ class TextThought (ResizableThought):
         self.index = 0
         self.end_index = len(self.text)
         self.attributes["font"] = "%s %d" % (font_name, font_size)
+        self.invalidate_layout()
 
         start = min(self.index, self.end_index)
         end = max(self.index, self.end_index)
@@ -1170,6 +1173,7 @@ class TextThought (ResizableThought):
             self.textview.hide()
             self.textview.destroy()
             self.textview = None
+            self.invalidate_layout()
 
     def leave(self):
         self.remove_textview()
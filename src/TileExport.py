@@ -0,0 +1,129 @@
+# TileExport.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Exports a map to an image one tile at a time, so that big maps don't
+# need one surface as big as the whole picture.  Tiles are rendered
+# through MMapArea.export, a row of tiles at a time, and their pixels
+# are handed on as RGB rows.
+
+import zlib
+import struct
+import cairo
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+import utils
+
+TILE_SIZE = 256
+# Compressed PNG data is written out in chunks of about this size
+IDAT_SIZE = 64 * 1024
+
+class PNGWriter:
+    ''' Writes an 8 bit RGB PNG to fileobj, taking the image a row at a \
+        time, so the picture never has to be in memory as a whole '''
+
+    def __init__(self, fileobj, width, height):
+        self.fileobj = fileobj
+        self.width = width
+        self.height = height
+        self.compressor = zlib.compressobj (6)
+        self.pending = []
+        self.pending_size = 0
+        self.fileobj.write ('\x89PNG\r\n\x1a\n')
+        self.chunk ('IHDR', struct.pack ('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def chunk (self, kind, data):
+        crc = zlib.crc32 (kind + data) & 0xffffffff
+        self.fileobj.write (struct.pack ('>I', len (data)))
+        self.fileobj.write (kind + data)
+        self.fileobj.write (struct.pack ('>I', crc))
+
+    def write_row (self, row):
+        # Each row starts with its filter type, 0 is none
+        data = self.compressor.compress ('\x00' + str (row))
+        if data:
+            self.pending.append (data)
+            self.pending_size += len (data)
+            if self.pending_size >= IDAT_SIZE:
+                self.flush ()
+
+    def flush (self):
+        if self.pending:
+            self.chunk ('IDAT', ''.join (self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close (self):
+        self.pending.append (self.compressor.flush ())
+        self.flush ()
+        self.chunk ('IEND', '')
+
+def tile_rows (area, width, height, native, tile_size = TILE_SIZE):
+    ''' Generator giving the map as exported by area.export (context, \
+        width, height, native), one row of RGB pixels at a time.  Only \
+        one tile surface and one row of tiles is kept at once'''
+    r, g, b, a = utils.ARGB32_ORDER
+    for ty in xrange (0, height, tile_size):
+        tile_height = min (tile_size, height - ty)
+        band = [bytearray () for i in xrange (tile_height)]
+        for tx in xrange (0, width, tile_size):
+            tile_width = min (tile_size, width - tx)
+            surface = cairo.ImageSurface (cairo.FORMAT_RGB24, tile_width, tile_height)
+            context = cairo.Context (surface)
+            context.rectangle (0, 0, tile_width, tile_height)
+            context.clip ()
+            context.translate (-tx, -ty)
+            area.export (context, width, height, native)
+            surface.flush ()
+
+            data = surface.get_data ()
+            stride = surface.get_stride ()
+            for y in xrange (tile_height):
+                src = bytearray (data[y * stride:y * stride + tile_width * 4])
+                rgb = bytearray (tile_width * 3)
+                rgb[0::3] = src[r::4]
+                rgb[1::3] = src[g::4]
+                rgb[2::3] = src[b::4]
+                band[y] += rgb
+            del context, surface
+
+        for row in band:
+            yield row
+
+def export_png (area, filename, width, height, native, tile_size = TILE_SIZE):
+    ''' Writes the map to filename as a PNG of width x height pixels '''
+    fileobj = open (filename, 'wb')
+    try:
+        writer = PNGWriter (fileobj, width, height)
+        for row in tile_rows (area, width, height, native, tile_size):
+            writer.write_row (row)
+        writer.close ()
+    finally:
+        fileobj.close ()
+
+def export_pixbuf (area, width, height, native, tile_size = TILE_SIZE):
+    ''' Returns the map as a GdkPixbuf, for formats that can't be written \
+        a row at a time.  It takes 3 bytes per pixel, rather than the 4 of \
+        a cairo surface plus a copy for the pixbuf '''
+    data = bytearray ()
+    for row in tile_rows (area, width, height, native, tile_size):
+        data += row
+    return GdkPixbuf.Pixbuf.new_from_bytes (GLib.Bytes.new (str (data)), GdkPixbuf.Colorspace.RGB,
+                                            False, 8, width, height, width * 3)
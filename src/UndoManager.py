@@ -19,6 +19,10 @@
 # Boston, MA  02110-1301  USA
 #
 
+
+import time
+from array import array
+
 # Different modes of operation - redo, undo
 UNDO = 0
 REDO = 1
@@ -33,6 +37,36 @@ DELETE_LETTER = 102
 DELETE_WORD = 103
 TRANSFORM_CANVAS = 104
 
+# Default limits of the history.  Past either of them the oldest
+# actions are forgotten
+MAX_ACTIONS = 500
+MAX_BYTES = 32 * 1024 * 1024
+
+# Actions started within this many seconds of the last one finishing
+# count as one burst, for the rules that only merge bursts
+COALESCE_TIME = 1.0
+
+# What estimate_size counts for an object it knows nothing about
+OBJECT_SIZE = 64
+
+def estimate_size (value):
+    ''' A rough count of the bytes kept alive by value, going into \
+        tuples, lists and dicts.  Other objects can tell for themselves \
+        with an undo_size () method '''
+    if isinstance (value, basestring):
+        return len (value)
+    if isinstance (value, (int, long, float)):
+        return 24
+    if isinstance (value, array):
+        return len (value) * value.itemsize
+    if isinstance (value, (tuple, list, set, frozenset)):
+        return OBJECT_SIZE + sum ([estimate_size (v) for v in value])
+    if isinstance (value, dict):
+        return OBJECT_SIZE + sum ([estimate_size (k) + estimate_size (v) for k, v in value.iteritems ()])
+    if hasattr (value, "undo_size"):
+        return value.undo_size ()
+    return OBJECT_SIZE
+
 class UndoAction:
     def __init__(self, owner, undo_type, callback, *args):
         self.owner = owner
@@ -46,9 +80,96 @@ class UndoAction:
                     self.text = z
                     break
         self.args = args
+        self.retained = []
+        self.size = None
+        # When the action was made and when it was added to the list
+        self.started = time.time ()
+        self.finished = None
+
     def add_arg (self, *args):
         for t in args:
             self.args += (t,)
+        self.size = None
+
+    def retain (self, *objects):
+        ''' Notes objects only this action keeps alive, like deleted \
+            thoughts, so they count towards the size of the history.  \
+            Objects with a memory_size () method are asked for it '''
+        self.retained.extend (objects)
+        self.size = None
+
+    def undo_size (self):
+        if self.size is None:
+            size = OBJECT_SIZE + estimate_size (self.args)
+            for obj in self.retained:
+                if hasattr (obj, "memory_size"):
+                    size += obj.memory_size ()
+                else:
+                    size += estimate_size (obj)
+            self.size = size
+        return self.size
+
+# Coalescing rules, see UndoManager.add_rule.  Each is given the last
+# action on the list and the one being added, and returns one action
+# doing the work of both, or None if they don't go together
+
+def in_burst (back, action):
+    ''' True if action undoes the same thing as back (has the same type \
+        and callback) and was started soon after back was added '''
+    return back.undo_type == action.undo_type and back.callback == action.callback and \
+        back.finished is not None and action.started - back.finished <= COALESCE_TIME
+
+def combine_insertions (back, action):
+    if back.owner != action.owner or \
+       (back.undo_type != INSERT_LETTER and back.undo_type != INSERT_WORD):
+        return None
+    # Words are undone one at a time
+    if back.text.rfind(' ') != -1:
+        return None
+    if back.args[0] <= action.args[0]:
+        start_iter = back.args[0]
+        final_text = back.text+action.text
+    else:
+        start_iter = action.args[0]
+        final_text = action.text+back.text
+    length = back.args[2] + action.args[2]
+    return UndoAction (action.owner, INSERT_WORD, action.callback, start_iter, final_text, length,
+                       back.args[3], action.args[4])
+
+def combine_deletions (back, action):
+    if back.owner != action.owner or \
+       (back.undo_type != DELETE_LETTER and back.undo_type != DELETE_WORD):
+        return None
+    if back.text.rfind(' ') != -1:
+        return None
+    if back.args[0] <= action.args[0]:
+        start_iter = back.args[0]
+        final_text = back.text+action.text
+        byte_collection = back.args[3] + action.args[3]
+    else:
+        start_iter = action.args[0]
+        final_text = action.text+back.text
+        byte_collection = action.args[3] + back.args[3]
+    length = back.args[2] + action.args[2]
+    return UndoAction (action.owner, DELETE_WORD, action.callback, start_iter, final_text, length,
+                       byte_collection, back.args[4], action.args[5])
+
+def combine_transforms (back, action):
+    if back.owner != action.owner or back.undo_type != TRANSFORM_CANVAS:
+        return None
+    # From where the first one started to where the last one ended
+    return UndoAction (action.owner, TRANSFORM_CANVAS, action.callback, back.args[0],
+                       action.args[1], back.args[2], action.args[3])
+
+def undo_group (action, mode):
+    ''' Undoes or redoes actions.args, the actions of a group, last first \
+        when undoing '''
+    if mode == UNDO:
+        actions = reversed (action.args)
+    else:
+        actions = action.args
+    for a in actions:
+        a.callback (a, mode=mode)
 
 class UndoManager:
     ''' A basic manager for undoing and redoing actions.\
@@ -57,9 +178,12 @@ class UndoManager:
         can add items to its lists and they're corresponding \
         methods will be called if and when needed.  The \
         manager doesn't care what you give it, so long as
-        it has a method to call and an owner'''
+        it has a method to call and an owner.  It keeps at \
+        most max_actions actions, of at most max_bytes as \
+        counted by their undo_size (), forgetting the oldest first'''
 
-    def __init__(self, top_owner, undo_widget = None, redo_widget = None):
+    def __init__(self, top_owner, undo_widget = None, redo_widget = None,
+                 max_actions = MAX_ACTIONS, max_bytes = MAX_BYTES):
         self.undo = undo_widget
         self.redo = redo_widget
 
@@ -67,6 +191,20 @@ class UndoManager:
 
         self.undo_list = []
         self.redo_list = []
+        # Size of the actions on undo_list
+        self.bytes = 0
+        self.evicted = 0
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        # Actions collected between begin_group and end_group
+        self.group = None
+        self.group_depth = 0
+
+        # undo_type -> rules merging new actions of that type
+        self.rules = {}
+        self.add_rule (INSERT_LETTER, combine_insertions)
+        self.add_rule (DELETE_LETTER, combine_deletions)
+        self.add_rule (TRANSFORM_CANVAS, combine_transforms)
 
         if self.undo:
             self.undo.connect('clicked', self.undo_action)
@@ -77,6 +215,64 @@ class UndoManager:
         self.owner = top_owner
         self.update_sensitive ()
 
+    def add_rule (self, undo_type, rule):
+        ''' Has rule (back, action) tried on each action of undo_type \
+            added, with the last action on the list.  If it gives back a \
+            combined action, that replaces both and is tried in turn \
+            with the one before.  Adding a rule twice has no effect '''
+        rules = self.rules.setdefault (undo_type, [])
+        if rule not in rules:
+            rules.append (rule)
+
+    def begin_group (self):
+        ''' Until the matching end_group, actions added are collected \
+            instead of going on the list.  Groups can be nested, the \
+            outermost one collects them all'''
+        if self.group_depth == 0:
+            self.group = []
+        self.group_depth += 1
+
+    def end_group (self):
+        ''' Returns the actions added since begin_group, in order, for \
+            the caller to add as one (see undo_group).  Inner groups \
+            return nothing, their actions go to the outer one'''
+        self.group_depth -= 1
+        if self.group_depth:
+            return []
+        group = self.group
+        self.group = None
+        return group
+
+    def set_limits (self, max_actions, max_bytes):
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.trim ()
+
+    def push (self, action):
+        self.undo_list.append (action)
+        self.bytes += action.undo_size ()
+
+    def pop_last (self):
+        action = self.undo_list.pop ()
+        self.bytes -= action.undo_size ()
+        return action
+
+    def trim (self):
+        # The latest action is kept, however big it is
+        while len (self.undo_list) > 1 and \
+              (len (self.undo_list) > self.max_actions or self.bytes > self.max_bytes):
+            action = self.undo_list.pop (0)
+            self.bytes -= action.undo_size ()
+            self.evicted += 1
+
+    def memory_usage (self):
+        ''' Returns the bytes the undo and redo lists keep alive, roughly '''
+        return self.bytes + sum ([a.undo_size () for a in self.redo_list])
+
+    def stats (self):
+        return "Undo: %d actions, %d to redo, %d bytes, %d forgotten" % \
+            (len (self.undo_list), len (self.redo_list), self.memory_usage (), self.evicted)
+
     def block (self):
         ''' Used as generally, when an undo is performed a \
         signal will be emitted that causes an undo action \
@@ -101,124 +297,36 @@ class UndoManager:
         self.redo.set_sensitive(len(self.redo_list) > 0)
 
     def undo_action (self, arg):
-        result = self.undo_list.pop()
+        result = self.pop_last ()
+        # Once undone, nothing more is merged into it
+        result.finished = None
         self.redo_list.append (result)
         self.update_sensitive ()
         result.callback (result, mode=UNDO)
 
     def forget_action (self):
-        result = self.undo_list.pop()
+        result = self.pop_last ()
         self.update_sensitive ()
         result.callback (result, mode=UNDO)
 
     def redo_action (self, arg):
         result = self.redo_list.pop()
-        self.undo_list.append (result)
+        self.push (result)
         self.update_sensitive ()
         result.callback (result, mode=REDO)
 
-    def combine_insertions (self, action):
-        final_text = action.text
-        start_iter = action.args[0]
-        length = action.args[2]
-        owner = action.owner
-        cb = action.callback
-        old_attrs = action.args[3]
-        new_attrs = action.args[4]
-        if len (self.undo_list) > 0:
-            back = self.undo_list.pop ()
-        else:
-            self.undo_list.append (action)
-            return
-        add_back = True
-        while back and back.owner == owner \
-              and (back.undo_type == INSERT_LETTER or back.undo_type == INSERT_WORD):
-            if back.text.rfind(' ') != -1:
-                break
-            old_attrs = back.args[3]
-            if back.args[0] <= start_iter:
-                start_iter = back.args[0]
-                final_text = back.text+final_text
-            else:
-                final_text += back.text
-            length += back.args[2]
-            if len (self.undo_list) == 0:
-                add_back = False
-                break
-            back = self.undo_list.pop ()
-        if add_back:
-            self.undo_list.append (back)
-        combi = UndoAction (owner, INSERT_WORD, cb, start_iter, final_text, length, old_attrs, new_attrs)
-        self.undo_list.append (combi)
-
-    def combine_deletions (self, action):
-        bytes = True
-        byte_collection = action.args[3]
-        final_text = action.text
-        start_iter = action.args[0]
-        length = action.args[2]
-        owner = action.owner
-        cb = action.callback
-        old_attrs = action.args[4]
-        new_attrs = action.args[5]
-        if len (self.undo_list) > 0:
-            back = self.undo_list.pop ()
-        else:
-            self.undo_list.append (action)
-            return
-        add_back = True
-        while back and back.owner == owner \
-              and (back.undo_type == DELETE_LETTER or back.undo_type == DELETE_WORD):
-            if back.text.rfind(' ') != -1:
-                break
-            old_attrs = back.args[4]
-            if back.args[0] <= start_iter:
-                start_iter = back.args[0]
-                final_text = back.text+final_text
-                if bytes:
-                    byte_collection = back.args[3] + byte_collection
-            else:
-                final_text += back.text
-                if bytes:
-                    byte_collection += back.args[3]
-            length += back.args[2]
-            if len (self.undo_list) == 0:
-                add_back = False
-                break
-            back = self.undo_list.pop ()
-        if add_back:
-            self.undo_list.append (back)
-        if bytes:
-            combi = UndoAction (owner, DELETE_WORD, cb, start_iter, final_text, length, byte_collection, old_attrs, new_attrs)
-        else:
-            combi = UndoAction (owner, DELETE_WORD, cb, start_iter, final_text, length, -1, old_attrs, new_attrs)
-        self.undo_list.append (combi)
-
-    def combine_transforms (self, action):
-        if len (self.undo_list) > 0:
-            back = self.undo_list.pop ()
-        else:
-            self.undo_list.append (action)
-            return
-        add_back = True
-        final_zoom = action.args[1]
-        final_trans = action.args[3]
-        orig_zoom = action.args[0]
-        orig_trans = action.args[2]
-        owner = action.owner
-        cb = action.callback
-        while back and back.owner == owner and \
-              back.undo_type == TRANSFORM_CANVAS:
-            orig_zoom = back.args[0]
-            orig_trans = back.args[2]
-            if len (self.undo_list) == 0:
-                add_back = False
-                break
-            back = self.undo_list.pop ()
-        if add_back:
-            self.undo_list.append (back)
-        self.undo_list.append (UndoAction (owner, TRANSFORM_CANVAS, cb, orig_zoom,
-                                           final_zoom, orig_trans, final_trans))
+    def coalesce (self, action):
+        ''' Puts action on the list, merged with the actions before it as \
+            far as the rules for its type go '''
+        for rule in self.rules.get (action.undo_type, ()):
+            while self.undo_list:
+                combined = rule (self.undo_list[-1], action)
+                if combined is None:
+                    break
+                combined.started = self.pop_last ().started
+                action = combined
+        action.finished = time.time ()
+        self.push (action)
 
     def peak (self):
         if len (self.undo_list) > 0:
@@ -228,7 +336,7 @@ class UndoManager:
 
     def pop (self):
         if len (self.undo_list) > 0:
-            return self.undo_list.pop ()
+            return self.pop_last ()
         else:
             return None
 
@@ -246,18 +354,12 @@ class UndoManager:
             print "Error: Not a valid undo action.  Ignoring."
             return
 
-        del self.redo_list[:]
-        if action.undo_type == INSERT_LETTER:
-            self.combine_insertions(action)
-
-        elif action.undo_type == DELETE_LETTER:
-            self.combine_deletions(action)
-
-        elif action.undo_type == TRANSFORM_CANVAS:
-            self.combine_transforms(action)
+        if self.group is not None:
+            self.group.append (action)
+            return
 
-        else:
-            self.undo_list.append (action)
+        del self.redo_list[:]
+        self.coalesce (action)
+        self.trim ()
 
         self.update_sensitive()
-
@@ -0,0 +1,155 @@
+# Utf8Index.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import re
+from array import array
+
+# Characters per block.  Blocks are split once they grow to twice this
+BLOCK_SIZE = 64
+
+# One character of UTF-8 text: a lead byte and its continuation bytes.
+# Stray continuation bytes count as characters of their own
+CHARACTER = re.compile ('[^\x80-\xbf][\x80-\xbf]{0,3}|[\x80-\xbf]{1,4}')
+
+def char_sizes (text):
+    ''' The number of bytes of each character of text, in UTF-8 '''
+    if isinstance (text, unicode):
+        text = text.encode ("utf-8")
+    return array ('B', [len (c) for c in CHARACTER.findall (text)])
+
+class Utf8Index:
+    ''' Maps between character and byte offsets in UTF-8 text that is \
+        being edited.  The byte size of each character is kept in blocks \
+        of about BLOCK_SIZE, with Fenwick trees of the characters and \
+        bytes in each block on top.  Finding an offset, inserting and \
+        deleting only touch a block and the trees, so they take time \
+        logarithmic in the length of the text'''
+
+    def __init__(self, text = ""):
+        sizes = char_sizes (text)
+        self.blocks = [sizes[i:i + BLOCK_SIZE] for i in xrange (0, len (sizes), BLOCK_SIZE)]
+        self.rebuild ()
+
+    def __len__(self):
+        return self.length
+
+    def rebuild (self):
+        ''' Remakes the trees, after blocks were added or removed '''
+        self.blocks = [b for b in self.blocks if b] or [array ('B')]
+        n = len (self.blocks)
+        self.chars = [0] * (n + 1)
+        self.nbytes = [0] * (n + 1)
+        self.top = 1
+        while self.top * 2 <= n:
+            self.top *= 2
+        self.length = 0
+        self.total = 0
+        for i, block in enumerate (self.blocks):
+            self.add (i, len (block), sum (block))
+
+    def add (self, block, chars, nbytes):
+        self.length += chars
+        self.total += nbytes
+        i = block + 1
+        while i < len (self.chars):
+            self.chars[i] += chars
+            self.nbytes[i] += nbytes
+            i += i & -i
+
+    def locate (self, tree, value):
+        ''' Returns the first block where the count in tree (self.chars \
+            or self.nbytes) goes past value, with the characters and bytes \
+            before it.  The block is len (self.blocks) if there is none '''
+        pos = chars = nbytes = 0
+        step = self.top
+        while step:
+            i = pos + step
+            if i < len (tree) and tree[i] <= value:
+                pos = i
+                value -= tree[i]
+                chars += self.chars[i]
+                nbytes += self.nbytes[i]
+            step >>= 1
+        return pos, chars, nbytes
+
+    def block_of (self, char):
+        ''' Like locate (self.chars, char), but gives the last block for \
+            the end of the text '''
+        pos, chars, nbytes = self.locate (self.chars, char)
+        if pos == len (self.blocks):
+            pos -= 1
+            chars -= len (self.blocks[pos])
+            nbytes -= sum (self.blocks[pos])
+        return pos, chars, nbytes
+
+    def byte_offset (self, char):
+        ''' The byte offset of character number char '''
+        if char >= self.length:
+            return self.total
+        char = max (0, char)
+        pos, chars, nbytes = self.locate (self.chars, char)
+        return nbytes + sum (self.blocks[pos][:char - chars])
+
+    def char_offset (self, offset):
+        ''' The number of whole characters in the first offset bytes '''
+        if offset >= self.total:
+            return self.length
+        pos, chars, nbytes = self.locate (self.nbytes, max (0, offset))
+        for size in self.blocks[pos]:
+            nbytes += size
+            if nbytes > offset:
+                break
+            chars += 1
+        return chars
+
+    def size (self, char):
+        ''' The number of bytes of character number char '''
+        pos, chars, nbytes = self.locate (self.chars, char)
+        return self.blocks[pos][char - chars]
+
+    def insert (self, char, text):
+        ''' Records text being inserted before character number char '''
+        sizes = char_sizes (text)
+        if not sizes:
+            return
+        pos, chars, nbytes = self.block_of (char)
+        block = self.blocks[pos]
+        block[char - chars:char - chars] = sizes
+        if len (block) < 2 * BLOCK_SIZE:
+            self.add (pos, len (sizes), sum (sizes))
+        else:
+            self.blocks[pos:pos + 1] = [block[i:i + BLOCK_SIZE] for i in xrange (0, len (block), BLOCK_SIZE)]
+            self.rebuild ()
+
+    def delete (self, start, end):
+        ''' Records the characters from start up to end being deleted '''
+        end = min (end, self.length)
+        emptied = False
+        while start < end:
+            pos, chars, nbytes = self.block_of (start)
+            block = self.blocks[pos]
+            first = start - chars
+            last = min (len (block), end - chars)
+            removed = sum (block[first:last])
+            del block[first:last]
+            self.add (pos, first - last, -removed)
+            end -= last - first
+            emptied = emptied or not block
+        if emptied:
+            self.rebuild ()
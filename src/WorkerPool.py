@@ -0,0 +1,79 @@
+# WorkerPool.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import Queue
+import logging
+import threading
+
+from gi.repository import GLib
+from gi.repository import GObject
+
+# Decoding and scaling mostly happens in C code that lets go of the
+# interpreter lock, so a couple of threads keep more than one core busy
+WORKERS = 2
+
+class WorkerPool:
+    ''' Runs slow jobs (decoding and scaling pictures) away from the GTK \
+        main loop.  Jobs must not touch widgets or thoughts; their result \
+        is handed to the callback from the main loop, through \
+        GLib.idle_add.  If a job raises, the error is logged and the \
+        callback gets None'''
+
+    def __init__(self, workers = WORKERS):
+        self.workers = workers
+        self.jobs = Queue.Queue()
+        self.threads = []
+
+    def submit (self, callback, func, *args):
+        if not self.threads:
+            self.start ()
+        self.jobs.put ((callback, func, args))
+
+    def start (self):
+        # A no-op on newer PyGObject, needed before using threads on older
+        if hasattr (GObject, "threads_init"):
+            GObject.threads_init ()
+        for i in range (self.workers):
+            thread = threading.Thread (target = self.run, name = "labyrinth-worker-%d" % i)
+            thread.daemon = True
+            thread.start ()
+            self.threads.append (thread)
+
+    def run (self):
+        while True:
+            callback, func, args = self.jobs.get ()
+            try:
+                result = func (*args)
+            except Exception, e:
+                logging.exception ("Background job failed: %s" % e)
+                result = None
+            GLib.idle_add (self.deliver, callback, result)
+
+    def deliver (self, callback, result):
+        callback (result)
+        return False
+
+pool = None
+
+def get_pool ():
+    ''' The pool shared by all thoughts, started on first use '''
+    global pool
+    if pool is None:
+        pool = WorkerPool ()
+    return pool
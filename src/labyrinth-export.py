@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# labyrinth-export.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+# Converts saved maps to PDF, SVG or PNG without opening a window, so it
+# also runs where there is no display:
+#
+#   labyrinth-export -f pdf,png -d 72,300 -o out/ 'maps/*.map'
+
+import glob
+import time
+import logging
+import optparse
+import sys, os
+import os.path as osp
+
+if os.name != 'nt':
+    def _check (path):
+        return osp.exists(path) and osp.isdir(path) and osp.isfile(path+"/AUTHORS")
+
+    name = osp.join(osp.dirname(__file__), '..')
+    if _check(name):
+        sys.path.insert(0, osp.abspath(name))
+
+    else:
+        sys.path.insert(0, osp.abspath("@PYTHONDIR@"))
+
+import ExportEngine
+
+def parse_list (value, convert):
+    return [convert (v.strip ()) for v in value.split (',') if v.strip ()]
+
+def parse_size (value):
+    width, height = value.lower ().split ('x')
+    return (int (width), int (height))
+
+def expand (patterns):
+    ''' The files matching each of patterns, in order, each once.  Quoted \
+        globs are expanded here, so long lists don't hit the limits of \
+        the shell '''
+    filenames = []
+    seen = set ()
+    for pattern in patterns:
+        matches = sorted (glob.glob (pattern))
+        if not matches:
+            print >> sys.stderr, "Warning: No maps match %s" % pattern
+        for filename in matches:
+            if filename not in seen:
+                seen.add (filename)
+                filenames.append (filename)
+    return filenames
+
+def report (done, total, result):
+    name = result.target.format
+    if result.target.dpi != ExportEngine.NATIVE_DPI:
+        name += " %d dpi" % result.target.dpi
+    if result.error:
+        print >> sys.stderr, "[%d/%d] %s (%s) failed after %.3f s\n%s" % \
+            (done, total, result.filename, name, result.seconds, result.error)
+    else:
+        print "[%d/%d] %s (%s) %.3f s -> %s" % \
+            (done, total, result.filename, name, result.seconds, ", ".join (result.outputs))
+    sys.stdout.flush ()
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] MAP|GLOB...")
+    parser.add_option("-f", "--format", dest="formats", default="pdf",
+        help="Comma separated formats to export to: pdf, svg, png [default: %default]")
+    parser.add_option("-d", "--dpi", dest="dpis", default=str (ExportEngine.NATIVE_DPI),
+        help="Comma separated resolutions, one export each [default: %default]")
+    parser.add_option("-p", "--page-size", dest="page_size", default=None,
+        help="Split maps into pages of WIDTHxHEIGHT points (pixels for png)")
+    parser.add_option("-o", "--output-dir", dest="directory", default=None,
+        help="Write the exports here instead of next to each map")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=0,
+        help="Processes to export with [default: one per core]")
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.error ("No maps given")
+    try:
+        formats = parse_list (options.formats, str.lower)
+        dpis = parse_list (options.dpis, int)
+        page_size = options.page_size and parse_size (options.page_size)
+        targets = [ExportEngine.ExportTarget (f, d, page_size) for f in formats for d in dpis]
+    except ValueError, e:
+        parser.error (str (e))
+
+    filenames = expand (args)
+    if not filenames:
+        sys.exit(1)
+    if options.directory and not osp.isdir (options.directory):
+        os.makedirs (options.directory)
+
+    logging.basicConfig ()
+    start = time.time ()
+    engine = ExportEngine.ExportEngine (targets, options.jobs, report)
+    results = engine.run (filenames, options.directory)
+
+    # Time spent on each map, over all of its targets
+    seconds = {}
+    for result in results:
+        seconds[result.filename] = seconds.get (result.filename, 0) + result.seconds
+    for filename in filenames:
+        print "%8.3f s  %s" % (seconds.get (filename, 0), filename)
+    failed = len ([r for r in results if r.error])
+    print "%d maps, %d exports, %d failed, %.3f s" % \
+        (len (filenames), len (results), failed, time.time () - start)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,10 @@ import os
 from array import array
 
 # Not available on OLPC's XO, but not needed neither
-#from Numeric import *
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from gi.repository import Gdk
 
@@ -48,6 +51,8 @@ def color_to_string(color):
     return '#%04x%04x%04x' % (color.red, color.green, color.blue)
 
 __BE_VERBOSE=os.environ.get('DEBUG_LABYRINTH',0)
+# For callers whose debug output costs something to put together
+debugging = bool(__BE_VERBOSE)
 if __BE_VERBOSE:
     def print_debug(*data):
         sys.stderr.write("\n".join(data) + "\n")
@@ -58,6 +63,12 @@ else:
 # FIXME: this is a no-go, but fast and efficient
 # global variables
 use_bezier_curves = True
+# How far (in map units) points of a finished drawing stroke may move
+# when it is simplified, 0 (the default) keeps every point
+drawing_tolerance = 0
+# Whether drawing strokes are drawn as curves through their points.
+# Separate from use_bezier_curves, which is about links
+smooth_drawings = False
 default_colors = {
     "text" : (0.0, 0.0, 0.0),
     "fg" : (0.0, 0.0, 0.0),
@@ -251,23 +262,87 @@ def export_thought_outline (context, ul, lr, background_color, am_root = False,
     real_lr = (lr[0]+move[0], lr[1]+move[1])
     draw_thought_extended (context, real_ul, real_lr, False, am_primary, background_color, style == STYLE_EXTENDED_CONTENT)
 
-def pixbuf_to_cairo (pixel_array):
-    imgW, imgH = len(pixel_array[0]), len(pixel_array)
-    data = array('B', [0] * imgW * imgH * 4)
-    for y in range(imgH):
-        for x in range(imgW):
-            # cairo.FORMAT_ARGB32 uses pre-multiplied alpha
-            try:
-                alpha = pixel_array[y][x][3]
-            except:
-                alpha = 255
-            alpha_mul = float(alpha) / 255
-
-            offset = (x + (y * imgW)) * 4
-            data[offset] = int(int(pixel_array[y][x][2]) * alpha_mul) # B
-            data[offset+1] = int(int(pixel_array[y][x][1]) * alpha_mul) # G
-            data[offset+2] = int(int(pixel_array[y][x][0]) * alpha_mul) # R
-            data[offset+3] = alpha # A
-
-    return data
-
+# cairo.FORMAT_ARGB32 keeps each pixel as a native endian 32 bit word,
+# ARGB32_ORDER has the positions of the red, green, blue and alpha bytes
+if sys.byteorder == 'little':
+    ARGB32_ORDER = (2, 1, 0, 3)
+else:
+    ARGB32_ORDER = (1, 2, 3, 0)
+# Offset of the high byte of a native 16 bit word, where the alpha goes
+# in the indices of the premultiply table
+ALPHA_BYTE = sys.byteorder == 'little' and 1 or 0
+
+def premultiply_table ():
+    # table[alpha * 256 + value] is value pre-multiplied by alpha, rounded
+    # the same way gdk_cairo_set_source_pixbuf does it
+    table = bytearray (256 * 256)
+    for alpha in xrange (256):
+        for value in xrange (256):
+            t = value * alpha + 0x80
+            table[alpha * 256 + value] = ((t >> 8) + t) >> 8
+    return table
+
+PREMULTIPLY = None
+
+def pixels_to_argb32_numpy (pixels, width, height, rowstride, n_channels, has_alpha):
+    data = numpy.frombuffer (pixels, numpy.uint8)
+    # The last row may be shorter than rowstride
+    if len (data) < rowstride * height:
+        data = numpy.concatenate ((data, numpy.zeros (rowstride * height - len (data), numpy.uint8)))
+    rgba = data[:rowstride * height].reshape (height, rowstride)[:, :width * n_channels]
+    rgba = rgba.reshape (height, width, n_channels)
+
+    out = numpy.empty ((height, width, 4), numpy.uint8)
+    r, g, b, a = ARGB32_ORDER
+    if has_alpha:
+        alpha = rgba[:, :, 3].astype (numpy.uint16)
+        for src, dst in ((0, r), (1, g), (2, b)):
+            t = rgba[:, :, src] * alpha + 0x80
+            out[:, :, dst] = ((t >> 8) + t) >> 8
+        out[:, :, a] = rgba[:, :, 3]
+    else:
+        out[:, :, r] = rgba[:, :, 0]
+        out[:, :, g] = rgba[:, :, 1]
+        out[:, :, b] = rgba[:, :, 2]
+        out[:, :, a] = 255
+    return array ('B', out.tostring ())
+
+def pixels_to_argb32_bytes (pixels, width, height, rowstride, n_channels, has_alpha):
+    global PREMULTIPLY
+    pixels = bytearray (pixels)
+    out = bytearray (width * height * 4)
+    r, g, b, a = ARGB32_ORDER
+    opaque = bytearray ('\xff') * width
+    for y in xrange (height):
+        row = pixels[y * rowstride:y * rowstride + width * n_channels]
+        start = y * width * 4
+        end = start + width * 4
+        alpha = has_alpha and row[3::4] or opaque
+        out[start+a:end:4] = alpha
+        if alpha == opaque:
+            # Nothing to multiply, copy the channels over in one go each
+            out[start+r:end:4] = row[0::n_channels]
+            out[start+g:end:4] = row[1::n_channels]
+            out[start+b:end:4] = row[2::n_channels]
+            continue
+        if PREMULTIPLY is None:
+            PREMULTIPLY = str (premultiply_table ())
+        # Each alpha and value pair, read as a native 16 bit word, is the
+        # index of the result in the table, so map () can look them all
+        # up without a Python level loop
+        index = bytearray (width * 2)
+        index[ALPHA_BYTE::2] = alpha
+        for src, dst in ((0, r), (1, g), (2, b)):
+            index[1 - ALPHA_BYTE::2] = row[src::4]
+            out[start+dst:end:4] = ''.join (map (PREMULTIPLY.__getitem__, array ('H', str (index))))
+    return array ('B', str (out))
+
+def pixbuf_to_cairo (pixbuf):
+    ''' Returns the pixels of pixbuf laid out for a cairo.FORMAT_ARGB32 \
+        surface of the same size, using a stride of width * 4 '''
+    if numpy:
+        convert = pixels_to_argb32_numpy
+    else:
+        convert = pixels_to_argb32_bytes
+    return convert (pixbuf.get_pixels (), pixbuf.get_width (), pixbuf.get_height (),
+                    pixbuf.get_rowstride (), pixbuf.get_n_channels (), pixbuf.get_has_alpha ())